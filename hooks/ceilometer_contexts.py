@@ -1,3 +1,9 @@
+import six
+if six.PY3:
+    from urllib.parse import quote, urlencode
+else:
+    from urllib import quote, urlencode
+
 from charmhelpers.core.hookenv import (
     relation_ids,
     relation_get,
@@ -10,9 +16,14 @@ from charmhelpers.contrib.openstack.utils import os_release
 from charmhelpers.contrib.openstack.context import (
     OSContextGenerator,
     context_complete,
+    db_ssl,
     ApacheSSLContext as SSLContext,
+    HTTPS_CONFIG_KEYS,
+    WorkerConfigContext,
 )
 
+from charmhelpers.contrib.network.ip import format_ipv6_addr
+
 from charmhelpers.contrib.hahelpers.cluster import (
     determine_apache_port,
     determine_api_port
@@ -22,12 +33,16 @@ CEILOMETER_DB = 'ceilometer'
 
 
 class LoggingConfigContext(OSContextGenerator):
+    config_keys = ['debug', 'verbose']
+
     def __call__(self):
         return {'debug': config('debug'), 'verbose': config('verbose')}
 
 
 class MongoDBContext(OSContextGenerator):
     interfaces = ['mongodb']
+    extra_interfaces = ['shared-db']
+    config_keys = []
 
     def __call__(self):
         mongo_servers = []
@@ -74,6 +89,10 @@ CEILOMETER_PORT = 8777
 
 
 class CeilometerContext(OSContextGenerator):
+    # The shared secret is distributed over the peer relation
+    extra_interfaces = ['cluster']
+    config_keys = []
+
     def __call__(self):
         # Lazy-import to avoid a circular dependency in the imports
         from ceilometer_utils import get_shared_secret
@@ -85,8 +104,117 @@ class CeilometerContext(OSContextGenerator):
         return ctxt
 
 
+class MeteringRetentionContext(OSContextGenerator):
+    config_keys = ['metering-time-to-live']
+
+    def __call__(self):
+        # ceilometer keeps samples forever unless time_to_live is positive
+        ttl = config('metering-time-to-live')
+        if ttl is None or ttl <= 0:
+            return {}
+        return {'time_to_live': ttl}
+
+
+class CeilometerWorkerContext(WorkerConfigContext):
+    # Daemons able to fork workers, through [DEFAULT] <daemon>_workers from
+    # icehouse onwards. ceilometer-api always runs a single process.
+    daemons = ['collector', 'notification']
+
+    def __call__(self):
+        # Avoid looking up the CPU count, which may install python-psutil,
+        # when workers are not configured.
+        if not config('worker-multiplier'):
+            return {}
+        workers = int(super(CeilometerWorkerContext, self).__call__()[
+            'workers'])
+        if workers < 1:
+            return {}
+        return dict(('{}_workers'.format(daemon), workers)
+                    for daemon in self.daemons)
+
+
+# SQL connections the API and collector processes of a unit may open
+# between them, see db_pool_settings.
+DB_CONNECTION_BUDGET = 100
+DB_MIN_POOL_SIZE = 5
+DB_POOL_CONFIG_KEYS = [
+    'database-max-pool-size',
+    'database-max-overflow',
+    'database-pool-timeout',
+    'database-idle-timeout',
+    'database-max-retries',
+]
+
+
+def db_pool_settings():
+    '''SQLAlchemy connection pool settings for SQL database backends.
+
+    Unless configured, the pool size and overflow of each process default to
+    an even share of DB_CONNECTION_BUDGET between the API and collector
+    worker processes, since those are the ones writing to and reading from
+    the database.
+    '''
+    workers = CeilometerWorkerContext()()
+    processes = 1 + workers.get('collector_workers', 1)
+    share = max(DB_MIN_POOL_SIZE, DB_CONNECTION_BUDGET // (2 * processes))
+    return {
+        'max_pool_size': config('database-max-pool-size') or share,
+        'max_overflow': config('database-max-overflow') or share,
+        'pool_timeout': config('database-pool-timeout'),
+        'idle_timeout': config('database-idle-timeout'),
+        'max_retries': config('database-max-retries'),
+    }
+
+
+class MySQLDBContext(OSContextGenerator):
+    interfaces = ['mysql-db']
+    config_keys = (['database', 'database-user'] + DB_POOL_CONFIG_KEYS +
+                   WorkerConfigContext.config_keys)
+
+    def __init__(self, ssl_dir=None):
+        self.ssl_dir = ssl_dir
+
+    def __call__(self):
+        '''Settings of the MySQL database provided over mysql-db, including
+        a complete connection URL with charset, SSL and pool settings.
+        '''
+        for relid in relation_ids('mysql-db'):
+            for unit in related_units(relid):
+                rdata = relation_get(unit=unit, rid=relid)
+                host = rdata.get('db_host') or rdata.get('host')
+                conf = {
+                    'database_host': format_ipv6_addr(host) or host,
+                    'database_name': config('database'),
+                    'database_user': config('database-user'),
+                    'database_password': rdata.get('password'),
+                    'database_type': 'mysql'
+                }
+                if not context_complete(conf):
+                    continue
+                db_ssl(rdata, conf, self.ssl_dir)
+                conf.update(db_pool_settings())
+                conf['database_connection'] = mysql_url(conf)
+                return conf
+        return {}
+
+
+def mysql_url(ctxt):
+    '''Build a SQLAlchemy mysql:// URL from a MySQLDBContext'''
+    params = [('charset', 'utf8')]
+    for option in ('ssl_ca', 'ssl_cert', 'ssl_key'):
+        if ctxt.get('database_' + option):
+            params.append((option, ctxt['database_' + option]))
+    return 'mysql://{}:{}@{}/{}?{}'.format(
+        quote(ctxt['database_user'], safe=''),
+        quote(ctxt['database_password'], safe=''),
+        ctxt['database_host'],
+        ctxt['database_name'],
+        urlencode(params))
+
+
 class CeilometerServiceContext(OSContextGenerator):
     interfaces = ['ceilometer-service']
+    config_keys = []
 
     def __call__(self):
         for relid in relation_ids('ceilometer-service'):
@@ -99,6 +227,9 @@ class CeilometerServiceContext(OSContextGenerator):
 
 class HAProxyContext(OSContextGenerator):
     interfaces = ['ceilometer-haproxy']
+    # Port layout depends on peers, https and the hacluster subordinate
+    extra_interfaces = ['cluster', 'identity-service', 'ha']
+    config_keys = HTTPS_CONFIG_KEYS
 
     def __call__(self):
         '''Extends the main charmhelpers HAProxyContext with a port mapping
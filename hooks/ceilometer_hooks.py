@@ -5,26 +5,27 @@ import subprocess
 import sys
 import os
 
-from charmhelpers.fetch import (
-    apt_install, filter_installed_packages,
-    apt_update
-)
+from charmhelpers.fetch import apt_transaction
 from charmhelpers.core.hookenv import (
     open_port,
     relation_get,
     relation_set,
     relation_ids,
     related_units,
+    local_unit,
     config,
     Hooks, UnregisteredHookError,
     log,
     is_relation_made,
+    relation_prefetch_mode,
     ERROR,
     unit_get
 )
 from charmhelpers.core.host import (
     service_restart,
+    service_reload,
     restart_on_change,
+    declare_service_ordering,
     lsb_release
 )
 from charmhelpers.contrib.openstack.utils import (
@@ -43,6 +44,10 @@ from ceilometer_utils import (
     get_shared_secret,
     do_openstack_upgrade,
     set_shared_secret,
+    configure_expirer,
+    check_dbsync,
+    migrate_database,
+    SERVICE_ORDERING,
 )
 from ceilometer_contexts import CEILOMETER_PORT
 from charmhelpers.contrib.openstack.ip import (
@@ -59,9 +64,11 @@ from charmhelpers.contrib.hahelpers.cluster import (
     is_elected_leader
 )
 from charmhelpers.payload.execd import execd_preinstall
+from charmhelpers.core import profiler, unitdata
 
 hooks = Hooks()
 CONFIGS = register_configs()
+declare_service_ordering(SERVICE_ORDERING)
 
 
 @hooks.hook()
@@ -72,9 +79,9 @@ def install():
             and origin == 'distro'):
         origin = 'cloud:precise-grizzly'
     configure_installation_source(origin)
-    apt_update(fatal=True)
-    apt_install(filter_installed_packages(get_packages()),
-                fatal=True)
+    with apt_transaction(fatal=True) as apt:
+        apt.update(max_age=config('apt-update-max-age'))
+        apt.install(get_packages())
     open_port(CEILOMETER_PORT)
 
 
@@ -110,24 +117,52 @@ def mysql_db_joined():
                  username=conf['database-user'],
                  hostname=host)
 
-    subprocess.call(['ceilometer-dbsync'])
 
 @hooks.hook("amqp-relation-changed",
             "shared-db-relation-changed",
-            "mysql-db-relation-changed"
             "shared-db-relation-departed",
             "mysql-db-relation-departed")
 @restart_on_change(restart_map())
 def any_changed():
-    CONFIGS.write_all()
+    CONFIGS.write_affected()
     configure_https()
     ceilometer_joined()
+    check_dbsync()
+
+
+@hooks.hook("mysql-db-relation-changed")
+@restart_on_change(restart_map())
+def mysql_db_changed():
+    any_changed()
+    sync_database()
+
+
+def database_access_granted():
+    """Whether the database service on mysql-db lists this unit in its
+    allowed_units, i.e. has granted it access to the database."""
+    for rid in relation_ids('mysql-db'):
+        for unit in related_units(rid):
+            allowed_units = relation_get('allowed_units', rid=rid, unit=unit)
+            if allowed_units and local_unit() in allowed_units.split():
+                return True
+    return False
+
+
+def sync_database():
+    if 'mysql-db' not in CONFIGS.complete_contexts():
+        log('mysql-db relation incomplete, deferring ceilometer-dbsync')
+        return
+    if not database_access_granted():
+        log('%s not yet allowed access to the database, deferring '
+            'ceilometer-dbsync' % local_unit())
+        return
+    migrate_database()
 
 
 @hooks.hook("identity-service-relation-changed")
 @restart_on_change(restart_map())
 def identity_service_relation_changed():
-    CONFIGS.write_all()
+    CONFIGS.write_affected()
     configure_https()
     keystone_joined()
 
@@ -138,14 +173,14 @@ def amqp_departed():
     if 'amqp' not in CONFIGS.complete_contexts():
         log('amqp relation incomplete. Peer not ready?')
         return
-    CONFIGS.write_all()
+    CONFIGS.write_affected()
 
 
 def configure_https():
     """Enables SSL API Apache config if appropriate."""
-    # need to write all to ensure changes to the entire request pipeline
-    # propagate (c-api, haprxy, apache)
-    CONFIGS.write_all()
+    # the https contexts declare their dependencies on the whole request
+    # pipeline (c-api, haproxy, apache) so affected files are all rewritten
+    CONFIGS.write_affected()
     if 'https' in CONFIGS.complete_contexts():
         cmd = ['a2ensite', 'openstack_https_frontend']
         subprocess.check_call(cmd)
@@ -155,10 +190,7 @@ def configure_https():
 
     # TODO: improve this by checking if local CN certs are available
     # first then checking reload status (see LP #1433114).
-    try:
-        subprocess.check_call(['service', 'apache2', 'reload'])
-    except subprocess.CalledProcessError:
-        subprocess.call(['service', 'apache2', 'restart'])
+    service_reload('apache2', restart_on_failure=True)
 
 
 @hooks.hook('config-changed')
@@ -170,6 +202,8 @@ def config_changed():
     CONFIGS.write_all()
     ceilometer_joined()
     configure_https()
+    configure_expirer()
+    sync_database()
     for rid in relation_ids('identity-service'):
         keystone_joined(relid=rid)
 
@@ -213,7 +247,8 @@ def cluster_changed():
     elif not shared_secret == get_shared_secret():
         set_shared_secret(shared_secret)
 
-    CONFIGS.write_all()
+    CONFIGS.write_affected()
+    configure_expirer()
 
 
 @hooks.hook('ha-relation-joined')
@@ -286,6 +321,8 @@ def ha_changed():
             'keystone endpoint configuration')
         for rid in relation_ids('identity-service'):
             keystone_joined(relid=rid)
+        # Leadership moves to the cluster resource once clustered
+        configure_expirer()
 
 
 @hooks.hook("identity-service-relation-joined")
@@ -345,7 +382,8 @@ def ceilometer_joined():
             'nrpe-external-master-relation-changed')
 def update_nrpe_config():
     # python-dbus is used by check_upstart_job
-    apt_install('python-dbus')
+    with apt_transaction() as apt:
+        apt.install('python-dbus')
     hostname = nrpe.get_nagios_hostname()
     current_unit = nrpe.get_nagios_unit_name()
     nrpe_setup = nrpe.NRPE(hostname=hostname)
@@ -356,7 +394,13 @@ def update_nrpe_config():
 
 
 if __name__ == '__main__':
+    # Contexts read several settings per related unit; fetch each unit's
+    # settings once instead of forking relation-get per attribute.
+    relation_prefetch_mode()
+    # Record where hook time goes; a summary is logged and kept in unitdata.
+    profiler.enable()
     try:
-        hooks.execute(sys.argv)
+        with unitdata.RelationSnapshot():
+            hooks.execute(sys.argv)
     except UnregisteredHookError as e:
         log('Unknown hook {} - skipping.'.format(e))
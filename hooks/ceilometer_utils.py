@@ -1,4 +1,6 @@
 import os
+import subprocess
+import time
 import uuid
 
 from collections import OrderedDict
@@ -12,15 +14,21 @@ from ceilometer_contexts import (
     LoggingConfigContext,
     MongoDBContext,
     CeilometerContext,
-    HAProxyContext
+    CeilometerWorkerContext,
+    MeteringRetentionContext,
+    HAProxyContext,
+    MySQLDBContext,
 )
 from charmhelpers.contrib.openstack.utils import (
     get_os_codename_package,
     get_os_codename_install_source,
     configure_installation_source
 )
-from charmhelpers.core.hookenv import config, log
-from charmhelpers.fetch import apt_update, apt_install, apt_upgrade
+from charmhelpers.contrib.hahelpers.cluster import is_elected_leader
+from charmhelpers.core import unitdata
+from charmhelpers.core.hookenv import config, log, ERROR
+from charmhelpers.core.host import write_file
+from charmhelpers.fetch import apt_transaction, installed_version
 from copy import deepcopy
 
 HAPROXY_CONF = '/etc/haproxy/haproxy.cfg'
@@ -66,6 +74,24 @@ ICEHOUSE_SERVICES = [
     'ceilometer-agent-notification'
 ]
 
+# Daemons consuming each section of ceilometer.conf. ceilometer-api reads
+# every section and is restarted on any change; other daemons are only
+# restarted when a section they consume changes, so that for instance a
+# [keystone_authtoken] change only restarts the API.
+CEILOMETER_SECTION_SERVICES = {
+    'DEFAULT': CEILOMETER_SERVICES,
+    'database': CEILOMETER_SERVICES,
+    'publisher_rpc': CEILOMETER_SERVICES,
+    'service_credentials': CEILOMETER_SERVICES,
+    'central': ['ceilometer-agent-central'],
+    'collector': ['ceilometer-collector'],
+    'alarm': ['ceilometer-alarm-evaluator', 'ceilometer-alarm-notifier'],
+    'notification': ['ceilometer-agent-notification'],
+}
+
+# Services picking up config changes with a graceful reload
+RELOAD_SERVICES = ['haproxy', 'apache2']
+
 CEILOMETER_ROLE = "ResellerAdmin"
 SVC = 'ceilometer'
 
@@ -76,8 +102,11 @@ CONFIG_FILES = OrderedDict([
                           context.AMQPContext(ssl_dir=CEILOMETER_CONF_DIR),
                           LoggingConfigContext(),
                           context.SharedDBContext(database=CEILOMETER_DB),
+                          MySQLDBContext(ssl_dir=CEILOMETER_CONF_DIR),
                           MongoDBContext(),
                           CeilometerContext(),
+                          CeilometerWorkerContext(),
+                          MeteringRetentionContext(),
                           context.SyslogContext(),
                           HAProxyContext()],
         'services': CEILOMETER_SERVICES
@@ -97,10 +126,34 @@ CONFIG_FILES = OrderedDict([
     })
 ])
 
+# Services whose restart must complete before another service is restarted:
+# the API is only brought back once its https and haproxy frontends are up.
+SERVICE_ORDERING = {
+    'ceilometer-api': ['apache2', 'haproxy'],
+}
+
 TEMPLATES = 'templates'
 
 SHARED_SECRET = "/etc/ceilometer/secret.txt"
 
+EXPIRER_CRON = "/etc/cron.d/ceilometer-expirer"
+EXPIRER_LOCK = "/var/lock/ceilometer-expirer.lock"
+EXPIRER_LOG = "/var/log/ceilometer/ceilometer-expirer.log"
+EXPIRER_CRON_TEMPLATE = (
+    "# Managed by juju, local changes will be overwritten.\n"
+    "{schedule} ceilometer timeout {max_runtime} "
+    "flock -n {lock} nice -n 19 ionice -c 3 "
+    "ceilometer-expirer >> {log} 2>&1\n"
+)
+
+# unitdata key holding the package version the database schema was last
+# migrated to, and the state of a migration running in the background
+DBSYNC_KEY = 'ceilometer.dbsync'
+DBSYNC_LOG = "/var/log/ceilometer/ceilometer-dbsync.log"
+# Exit status of a background ceilometer-dbsync, written once it finishes
+DBSYNC_STATUS = "/var/lib/ceilometer/dbsync.status"
+BOOT_ID = "/proc/sys/kernel/random/boot_id"
+
 
 def register_configs():
     """
@@ -114,7 +167,8 @@ def register_configs():
     release = get_os_codename_package('ceilometer-common', fatal=False) \
         or 'grizzly'
     configs = templating.OSConfigRenderer(templates_dir=TEMPLATES,
-                                          openstack_release=release)
+                                          openstack_release=release,
+                                          render_threads=len(CONFIG_FILES))
 
     if (get_os_codename_install_source(config('openstack-origin'))
             >= 'icehouse'):
@@ -138,24 +192,39 @@ def restart_map():
     Determine the correct resource map to be passed to
     charmhelpers.core.restart_on_change() based on the services configured.
 
-    :returns: dict: A dictionary mapping config file to lists of services
-                    that should be restarted when file changes.
+    :returns: dict: A dictionary mapping config file to a dict of the
+                    services to act on when the file changes, and whether
+                    they are reloaded, restarted, or only restarted when one
+                    of a list of INI sections changes.
     '''
     _map = {}
     for f, ctxt in CONFIG_FILES.iteritems():
-        svcs = []
+        svcs = {}
         for svc in ctxt['services']:
-            svcs.append(svc)
+            if svc in RELOAD_SERVICES:
+                svcs[svc] = 'reload'
+            elif svc != 'ceilometer-api' and svc in CEILOMETER_SERVICES:
+                svcs[svc] = service_sections(svc)
+            else:
+                svcs[svc] = 'restart'
         if svcs:
             _map[f] = svcs
     return _map
 
 
+def service_sections(service):
+    '''
+    Return the sorted list of ceilometer.conf sections consumed by service.
+    '''
+    return sorted(section for section, svcs in
+                  CEILOMETER_SECTION_SERVICES.iteritems() if service in svcs)
+
+
 def services():
     ''' Returns a list of services associate with this charm '''
     _services = []
     for v in restart_map().values():
-        _services = _services + v
+        _services = _services + list(v)
     return list(set(_services))
 
 
@@ -185,11 +254,10 @@ def do_openstack_upgrade(configs):
         '--option', 'Dpkg::Options::=--force-confnew',
         '--option', 'Dpkg::Options::=--force-confdef',
     ]
-    apt_update(fatal=True)
-    apt_upgrade(options=dpkg_opts, fatal=True, dist=True)
-    apt_install(packages=get_packages(),
-                options=dpkg_opts,
-                fatal=True)
+    with apt_transaction(options=dpkg_opts, fatal=True) as apt:
+        apt.update(max_age=config('apt-update-max-age'))
+        apt.upgrade(dist=True)
+        apt.install(get_packages())
 
     # set CONFIGS to load templates from new release
     configs.set_release(openstack_release=new_os_rel)
@@ -226,3 +294,141 @@ def set_shared_secret(secret):
     """
     with open(SHARED_SECRET, 'w') as secret_file:
         secret_file.write(secret)
+
+
+def configure_expirer():
+    """
+    Install the cron job purging expired samples with ceilometer-expirer
+    when metering-time-to-live is set. Samples live in a database shared by
+    all units, so the job only runs on the elected leader and is removed
+    from every other unit.
+    """
+    ttl = config('metering-time-to-live')
+    if ttl is not None and ttl > 0 and is_elected_leader(CLUSTER_RES):
+        log('Scheduling ceilometer-expirer: %s' % config('expirer-schedule'))
+        write_file(EXPIRER_CRON,
+                   EXPIRER_CRON_TEMPLATE.format(
+                       schedule=config('expirer-schedule'),
+                       max_runtime=config('expirer-max-runtime'),
+                       lock=EXPIRER_LOCK, log=EXPIRER_LOG),
+                   perms=0o644)
+    elif os.path.exists(EXPIRER_CRON):
+        log('Removing ceilometer-expirer cron job')
+        os.remove(EXPIRER_CRON)
+
+
+def _process_start(pid):
+    """
+    Identify the process running as pid by the boot and the time since boot
+    at which it started, so that a pid reused by another process, after a
+    reboot for instance, is told apart.
+
+    :returns: str: the identifier, or None if no process has that pid.
+    """
+    try:
+        with open('/proc/%d/stat' % pid, 'r') as stat:
+            # Fields follow the parenthesised command name, which may itself
+            # contain spaces; starttime is the 22nd field overall.
+            starttime = stat.read().rsplit(')', 1)[1].split()[19]
+        with open(BOOT_ID, 'r') as boot_id:
+            return '%s:%s' % (boot_id.read().strip(), starttime)
+    except (IOError, IndexError):
+        return None
+
+
+def _last_line(path):
+    try:
+        with open(path, 'r') as log_file:
+            lines = log_file.read().strip().splitlines()
+    except IOError:
+        return ''
+    return lines[-1] if lines else ''
+
+
+def _dbsync_finished(kv, state, success):
+    version = state.pop('pending')
+    state.pop('pid', None)
+    state.pop('process', None)
+    state.pop('started', None)
+    if success:
+        log('ceilometer database migrated to %s' % version)
+        state['revision'] = version
+    else:
+        log('ceilometer-dbsync to %s failed, see %s' % (version, DBSYNC_LOG),
+            level=ERROR)
+    kv.set(DBSYNC_KEY, state)
+    kv.flush()
+
+
+def check_dbsync():
+    """
+    Report on a ceilometer-dbsync started in the background by an earlier
+    hook, recording the migrated revision once it has finished.
+
+    :returns: True while the migration is still running.
+    """
+    kv = unitdata.kv()
+    state = kv.get(DBSYNC_KEY) or {}
+    if not state.get('pending'):
+        return False
+    process = state.get('process')
+    if process is not None and _process_start(state['pid']) == process:
+        log('ceilometer-dbsync to %s running for %ds: %s' %
+            (state['pending'], time.time() - state['started'],
+             _last_line(DBSYNC_LOG)))
+        return True
+    # The exit status is written just before the process exits, so it is
+    # only complete once the process is gone.
+    if os.path.exists(DBSYNC_STATUS):
+        with open(DBSYNC_STATUS, 'r') as status:
+            success = status.read().strip() == '0'
+        os.remove(DBSYNC_STATUS)
+    else:
+        # Killed before it could write its exit status, e.g. by a reboot
+        success = False
+    _dbsync_finished(kv, state, success)
+    return False
+
+
+def migrate_database():
+    """
+    Migrate the ceilometer database schema with ceilometer-dbsync when the
+    installed ceilometer-common differs from the version the schema was last
+    migrated to. Only the elected leader migrates, so units never run
+    concurrent migrations against the shared database.
+
+    With dbsync-background set the migration is detached from the hook and
+    its progress is reported by check_dbsync in later hooks.
+    """
+    if not is_elected_leader(CLUSTER_RES):
+        log('Deferring ceilometer-dbsync to the elected leader')
+        return
+    if check_dbsync():
+        return
+    version = installed_version('ceilometer-common')
+    kv = unitdata.kv()
+    state = kv.get(DBSYNC_KEY) or {}
+    if version is None or state.get('revision') == version:
+        return
+
+    log('Migrating ceilometer database to %s' % version)
+    state['pending'] = version
+    if config('dbsync-background'):
+        if os.path.exists(DBSYNC_STATUS):
+            os.remove(DBSYNC_STATUS)
+        with open(os.devnull, 'r+') as devnull:
+            proc = subprocess.Popen(
+                ['sh', '-c', 'ceilometer-dbsync >> "$0" 2>&1; echo $? > "$1"',
+                 DBSYNC_LOG, DBSYNC_STATUS],
+                stdin=devnull, stdout=devnull, stderr=devnull,
+                close_fds=True, preexec_fn=os.setsid)
+        state['pid'] = proc.pid
+        state['process'] = _process_start(proc.pid)
+        state['started'] = time.time()
+        kv.set(DBSYNC_KEY, state)
+        kv.flush()
+    else:
+        with open(DBSYNC_LOG, 'a') as out:
+            ret = subprocess.call(['ceilometer-dbsync'], stdout=out,
+                                  stderr=subprocess.STDOUT)
+        _dbsync_finished(kv, state, ret == 0)
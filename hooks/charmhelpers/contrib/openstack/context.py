@@ -17,6 +17,7 @@
 import json
 import os
 import re
+import threading
 import time
 from base64 import b64decode
 from subprocess import check_call
@@ -186,9 +187,27 @@ def config_flags_parser(config_flags):
     return flags
 
 
+# Charm options that decide whether HTTPS is used and which ports the API,
+# haproxy and apache listen on; see hahelpers.cluster.
+HTTPS_CONFIG_KEYS = ['use-https', 'ssl_cert', 'ssl_key', 'ssl_ca']
+NETWORK_CONFIG_KEYS = ['vip', 'prefer-ipv6', 'os-admin-network',
+                       'os-internal-network', 'os-public-network']
+
+
 class OSContextGenerator(object):
-    """Base class for all context generators."""
+    """Base class for all context generators.
+
+    Generators that declare ``config_keys`` (the charm options they read)
+    have their dependencies tracked by OSConfigRenderer: together with the
+    relations listed in ``interfaces`` and ``extra_interfaces`` they
+    determine which config files a hook has to re-render. Generators that
+    leave ``config_keys`` as None are assumed to depend on everything.
+    """
     interfaces = []
+    # Relations read by the generator that it does not report completeness
+    # for through interfaces.
+    extra_interfaces = []
+    config_keys = None
 
     def __call__(self):
         raise NotImplementedError
@@ -196,6 +215,7 @@ class OSContextGenerator(object):
 
 class SharedDBContext(OSContextGenerator):
     interfaces = ['shared-db']
+    config_keys = ['database', 'database-user']
 
     def __init__(self,
                  database=None, user=None, relation_prefix=None, ssl_dir=None):
@@ -260,6 +280,7 @@ class SharedDBContext(OSContextGenerator):
 
 class PostgresqlDBContext(OSContextGenerator):
     interfaces = ['pgsql-db']
+    config_keys = ['database']
 
     def __init__(self, database=None):
         self.database = database
@@ -326,6 +347,7 @@ class IdentityServiceContext(OSContextGenerator):
         self.service_user = service_user
         self.rel_name = rel_name
         self.interfaces = [self.rel_name]
+        self.config_keys = []
 
     def __call__(self):
         log('Generating template context for ' + self.rel_name, level=DEBUG)
@@ -378,6 +400,12 @@ class AMQPContext(OSContextGenerator):
         self.rel_name = rel_name
         self.relation_prefix = relation_prefix
         self.interfaces = [rel_name]
+        if relation_prefix:
+            self.config_keys = ['%s-rabbit-user' % (relation_prefix),
+                                '%s-rabbit-vhost' % (relation_prefix)]
+        else:
+            self.config_keys = ['rabbit-user', 'rabbit-vhost']
+        self.config_keys.append('oslo-messaging-flags')
 
     def __call__(self):
         log('Generating template context for amqp', level=DEBUG)
@@ -516,6 +544,8 @@ class HAProxyContext(OSContextGenerator):
     its own context generator that describes the port mapping.
     """
     interfaces = ['cluster']
+    config_keys = NETWORK_CONFIG_KEYS + ['haproxy-server-timeout',
+                                         'haproxy-client-timeout']
 
     def __init__(self, singlenode_mode=False):
         self.singlenode_mode = singlenode_mode
@@ -641,6 +671,8 @@ class ApacheSSLContext(OSContextGenerator):
     to internal ports.
     """
     interfaces = ['https']
+    extra_interfaces = ['identity-service', 'cluster', 'ha']
+    config_keys = HTTPS_CONFIG_KEYS + NETWORK_CONFIG_KEYS
 
     # charms should inherit this context and set external ports
     # and service namespace accordingly.
@@ -1096,6 +1128,7 @@ class SubordinateConfigContext(OSContextGenerator):
 
 
 class LogLevelContext(OSContextGenerator):
+    config_keys = ['debug', 'verbose']
 
     def __call__(self):
         ctxt = {}
@@ -1108,6 +1141,7 @@ class LogLevelContext(OSContextGenerator):
 
 
 class SyslogContext(OSContextGenerator):
+    config_keys = ['use-syslog']
 
     def __call__(self):
         ctxt = {'use_syslog': config('use-syslog')}
@@ -1115,6 +1149,7 @@ class SyslogContext(OSContextGenerator):
 
 
 class BindHostContext(OSContextGenerator):
+    config_keys = ['prefer-ipv6']
 
     def __call__(self):
         if config('prefer-ipv6'):
@@ -1123,15 +1158,22 @@ class BindHostContext(OSContextGenerator):
             return {'bind_host': '0.0.0.0'}
 
 
+# Serialises the python-psutil install of contexts evaluated concurrently,
+# see OSConfigRenderer.
+_num_cpus_lock = threading.Lock()
+
+
 class WorkerConfigContext(OSContextGenerator):
+    config_keys = ['worker-multiplier']
 
     @property
     def num_cpus(self):
-        try:
-            from psutil import NUM_CPUS
-        except ImportError:
-            apt_install('python-psutil', fatal=True)
-            from psutil import NUM_CPUS
+        with _num_cpus_lock:
+            try:
+                from psutil import NUM_CPUS
+            except ImportError:
+                apt_install('python-psutil', fatal=True)
+                from psutil import NUM_CPUS
 
         return NUM_CPUS
 
@@ -14,13 +14,30 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with charm-helpers.  If not, see <http://www.gnu.org/licenses/>.
 
+import hashlib
 import os
+import stat
+import tempfile
+import threading
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 import six
 
-from charmhelpers.fetch import apt_install
+from charmhelpers.fetch import apt_transaction
+from charmhelpers.core import profiler
+from charmhelpers.core.host import (
+    file_hash,
+    record_file_hash,
+    CHANGE_HASH,
+)
 from charmhelpers.core.hookenv import (
+    charm_dir,
+    config,
+    hook_name,
     log,
+    relation_type,
+    relation_writes,
     ERROR,
     INFO
 )
@@ -28,15 +45,72 @@ from charmhelpers.contrib.openstack.utils import OPENSTACK_CODENAMES
 
 try:
     from jinja2 import FileSystemLoader, ChoiceLoader, Environment, exceptions
+    from jinja2 import FileSystemBytecodeCache
 except ImportError:
     # python-jinja2 may not be installed yet, or we're running unittests.
     FileSystemLoader = ChoiceLoader = Environment = exceptions = None
+    FileSystemBytecodeCache = None
+
+# Directory under the charm dir holding compiled templates per release.
+BYTECODE_CACHE_DIR = '.jinja2-bytecode'
 
 
 class OSConfigException(Exception):
     pass
 
 
+# Results of context generators evaluated during this hook, see
+# evaluate_context().
+_context_cache = {}
+# Per-generator locks so that concurrent renders evaluate each generator
+# only once.
+_context_locks = {}
+_context_locks_lock = threading.Lock()
+
+
+def _context_key(context):
+    """Identify a context generator by its class and settings, so that
+    equally configured instances registered for several files share one
+    cache entry.
+
+    The key is taken when an instance is first seen and kept on it, since
+    generators such as SharedDBContext set attributes when called."""
+    if not hasattr(context, 'interfaces') or not hasattr(context, '__dict__'):
+        return context
+    key = vars(context).get('_context_key')
+    if key is None:
+        key = (context.__class__, repr(sorted(vars(context).items())))
+        context._context_key = key
+    return key
+
+
+def evaluate_context(context):
+    """
+    Call a context generator, reusing its result if an equivalent generator
+    has already been called during this hook.
+
+    Cached results are discarded once the unit writes relation data, since
+    generators may defer on (or react to) the local unit's settings.
+    """
+    key = _context_key(context)
+    with _context_locks_lock:
+        lock = _context_locks.setdefault(key, threading.Lock())
+    with lock:
+        generation = relation_writes()
+        cached = _context_cache.get(key)
+        if cached is not None and cached[0] == generation:
+            return cached[1]
+        with profiler.context(context.__class__.__name__):
+            result = context()
+        _context_cache[key] = (generation, result)
+    return result
+
+
+def flush_context_cache():
+    """Discard all cached context generator results"""
+    _context_cache.clear()
+
+
 def get_loader(templates_dir, os_release):
     """
     Create a jinja2.ChoiceLoader containing template dirs up to
@@ -83,6 +157,35 @@ def get_loader(templates_dir, os_release):
     return ChoiceLoader(loaders)
 
 
+def _open_replacement(path):
+    """
+    Open a temporary file next to path which can be renamed over it,
+    carrying over the ownership and permissions of the existing file.
+
+    :returns: tuple of the open file object and its path.
+    """
+    dirname, basename = os.path.split(path)
+    fd, tmp_path = tempfile.mkstemp(prefix='.%s.' % basename, dir=dirname)
+    if os.path.exists(path):
+        st = os.stat(path)
+        os.fchown(fd, st.st_uid, st.st_gid)
+        os.fchmod(fd, stat.S_IMODE(st.st_mode))
+    else:
+        umask = os.umask(0)
+        os.umask(umask)
+        os.fchmod(fd, 0o666 & ~umask)
+    return os.fdopen(fd, 'wb'), tmp_path
+
+
+def _fsync_dir(dirname):
+    """Make renames within dirname durable"""
+    fd = os.open(dirname or '.', os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
 class OSConfigTemplate(object):
     """
     Associates a config file template with a list of context generators.
@@ -101,7 +204,7 @@ class OSConfigTemplate(object):
     def context(self):
         ctxt = {}
         for context in self.contexts:
-            _ctxt = context()
+            _ctxt = evaluate_context(context)
             if _ctxt:
                 ctxt.update(_ctxt)
                 # track interfaces for every complete context.
@@ -110,6 +213,23 @@ class OSConfigTemplate(object):
                  if interface not in self._complete_contexts]
         return ctxt
 
+    def dependencies(self):
+        """
+        Return the set of ('relation', name) and ('config', key) pairs the
+        contexts of this file read, or None if any context has not declared
+        its dependencies.
+        """
+        deps = set()
+        for context in self.contexts:
+            config_keys = getattr(context, 'config_keys', None)
+            if config_keys is None:
+                return None
+            deps.update(('config', k) for k in config_keys)
+            deps.update(('relation', r) for r in
+                        (list(getattr(context, 'interfaces', [])) +
+                         list(getattr(context, 'extra_interfaces', []))))
+        return deps
+
     def complete_contexts(self):
         '''
         Return a list of interfaces that have atisfied contexts.
@@ -192,8 +312,13 @@ class OSConfigRenderer(object):
     of generators.  When a template is rendered and written, all context
     generates are called in a chain to generate the context dictionary
     passed to the jinja2 template. See context.py for more info.
+
+    Each generator is evaluated at most once per hook, even when it is
+    registered for several files or write_all() is called repeatedly; see
+    evaluate_context(). Passing render_threads > 1 evaluates the contexts of
+    different files concurrently.
     """
-    def __init__(self, templates_dir, openstack_release):
+    def __init__(self, templates_dir, openstack_release, render_threads=1):
         if not os.path.isdir(templates_dir):
             log('Could not locate templates dir %s' % templates_dir,
                 level=ERROR)
@@ -201,14 +326,20 @@ class OSConfigRenderer(object):
 
         self.templates_dir = templates_dir
         self.openstack_release = openstack_release
-        self.templates = {}
+        self.render_threads = render_threads
+        self.templates = OrderedDict()
+        # Dependency graph: ('relation', name) or ('config', key) -> files
+        # whose contexts read it; files in _untracked depend on everything.
+        self._dependents = {}
+        self._untracked = set()
         self._tmpl_env = None
 
         if None in [Environment, ChoiceLoader, FileSystemLoader]:
             # if this code is running, the object is created pre-install hook.
             # jinja2 shouldn't get touched until the module is reloaded on next
             # hook execution, with proper jinja2 bits successfully imported.
-            apt_install('python-jinja2')
+            with apt_transaction() as apt:
+                apt.install('python-jinja2')
 
     def register(self, config_file, contexts):
         """
@@ -217,12 +348,45 @@ class OSConfigRenderer(object):
         """
         self.templates[config_file] = OSConfigTemplate(config_file=config_file,
                                                        contexts=contexts)
+        self._untracked.discard(config_file)
+        for files in six.itervalues(self._dependents):
+            files.discard(config_file)
+        deps = self.templates[config_file].dependencies()
+        if deps is None:
+            self._untracked.add(config_file)
+        else:
+            for dep in deps:
+                self._dependents.setdefault(dep, set()).add(config_file)
         log('Registered config file: %s' % config_file, level=INFO)
 
     def _get_tmpl_env(self):
         if not self._tmpl_env:
             loader = get_loader(self.templates_dir, self.openstack_release)
-            self._tmpl_env = Environment(loader=loader)
+            self._tmpl_env = Environment(
+                loader=loader, bytecode_cache=self._get_bytecode_cache())
+
+    def _get_bytecode_cache(self):
+        """
+        Return a bytecode cache persisting compiled templates across hook
+        executions, or None if there is no charm dir to store it in.
+
+        Entries are kept per OpenStack release and are keyed by template
+        name and path; jinja2 discards an entry whenever the checksum of its
+        template source changes, so an upgraded charm never renders stale
+        templates.
+        """
+        if FileSystemBytecodeCache is None or not charm_dir():
+            return None
+        cache_dir = os.path.join(charm_dir(), BYTECODE_CACHE_DIR,
+                                 self.openstack_release)
+        if not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                log('Unable to create template cache dir %s' % cache_dir,
+                    level=INFO)
+                return None
+        return FileSystemBytecodeCache(cache_dir)
 
     def _get_template(self, template):
         self._get_tmpl_env()
@@ -253,28 +417,139 @@ class OSConfigRenderer(object):
                 raise e
 
         log('Rendering from template: %s' % _tmpl, level=INFO)
-        return template.render(ctxt)
+        with profiler.timed('render %s' % _tmpl):
+            return template.render(ctxt)
 
     def write(self, config_file):
         """
         Write a single config file, raises if config file is not registered.
-        """
-        if config_file not in self.templates:
-            log('Config not registered: %s' % config_file, level=ERROR)
-            raise OSConfigException
-
-        _out = self.render(config_file)
 
-        with open(config_file, 'wb') as out:
-            out.write(_out)
+        The file is left untouched if its content already matches the
+        rendered template.
 
-        log('Wrote template %s.' % config_file, level=INFO)
+        :returns: True if the file was written, False if it was unchanged.
+        """
+        return self._write_files([config_file])[config_file]
 
     def write_all(self):
         """
         Write out all registered config files.
+
+        All files are rendered before any is replaced, concurrently when
+        render_threads is greater than one, and are written in registration
+        order. Changed files are written to temporary files alongside their
+        targets, synced to disk together and then renamed into place, so
+        services never read a partially written config.
+
+        :returns: dict mapping each config file to whether it was changed.
         """
-        [self.write(k) for k in six.iterkeys(self.templates)]
+        return self._write_files(list(six.iterkeys(self.templates)))
+
+    def affected_files(self, relation=None, config_keys=None):
+        """
+        Return the registered files, in registration order, whose contexts
+        read the relation named relation or any of config_keys.
+        """
+        affected = set(self._untracked)
+        if relation:
+            affected.update(self._dependents.get(('relation', relation), ()))
+        for key in (config_keys or []):
+            affected.update(self._dependents.get(('config', key), ()))
+        return [f for f in self.templates if f in affected]
+
+    def write_affected(self, relation=None, config_keys=None):
+        """
+        Write out only the config files affected by a change to a relation
+        or to charm config options.
+
+        When neither is given they are taken from the running hook: the
+        relation of a relation hook, or the options that changed for
+        config-changed. Any other hook writes all registered files.
+
+        :returns: dict mapping each written config file to whether it was
+                  changed.
+        """
+        if relation is None and config_keys is None:
+            relation = relation_type()
+            if hook_name() == 'config-changed':
+                cfg = config()
+                if hasattr(cfg, 'changed'):
+                    config_keys = [k for k in cfg.keys() if cfg.changed(k)]
+            if relation is None and config_keys is None:
+                return self.write_all()
+        config_files = self.affected_files(relation, config_keys)
+        log('Writing config files affected by %s: %s' %
+            (relation or ', '.join(config_keys), ', '.join(config_files)),
+            level=INFO)
+        return self._write_files(config_files)
+
+    def _write_files(self, config_files):
+        for config_file in config_files:
+            if config_file not in self.templates:
+                log('Config not registered: %s' % config_file, level=ERROR)
+                raise OSConfigException
+
+        changed = {}
+        pending = []
+        try:
+            for config_file, _out in zip(config_files,
+                                         self._render_files(config_files)):
+                if isinstance(_out, six.text_type):
+                    _out = _out.encode('UTF-8')
+                digest = getattr(hashlib, CHANGE_HASH)(_out).hexdigest()
+
+                if digest == file_hash(config_file, CHANGE_HASH):
+                    log('Template %s unchanged, not writing.' % config_file,
+                        level=INFO)
+                    changed[config_file] = False
+                    continue
+
+                # Replace the target of a symlinked config, not the link.
+                target = os.path.realpath(config_file)
+                out, tmp_path = _open_replacement(target)
+                pending.append((config_file, target, out, tmp_path, digest))
+                out.write(_out)
+                out.flush()
+
+            # One durability barrier for the whole batch.
+            for _, _, out, _, _ in pending:
+                os.fsync(out.fileno())
+                out.close()
+            for config_file, target, _, tmp_path, digest in pending:
+                os.rename(tmp_path, target)
+                record_file_hash(config_file, digest, CHANGE_HASH)
+                changed[config_file] = True
+                log('Wrote template %s.' % config_file, level=INFO)
+        finally:
+            for config_file, _, out, tmp_path, _ in pending:
+                if not changed.get(config_file):
+                    out.close()
+                    if os.path.exists(tmp_path):
+                        os.unlink(tmp_path)
+
+        for dirname in set(os.path.dirname(t) for _, t, _, _, _ in pending):
+            _fsync_dir(dirname)
+        return changed
+
+    def _render_files(self, config_files):
+        """
+        Render config_files, concurrently if the renderer was created with
+        more than one render thread.
+
+        Context generators spend most of their time waiting on hook tools,
+        so rendering independent files in parallel overlaps those waits.
+        """
+        threads = min(self.render_threads or 1, len(config_files))
+        if threads <= 1:
+            return [self.render(f) for f in config_files]
+        # Create the template environment before the workers race for it.
+        self._get_tmpl_env()
+        pool = ThreadPool(threads)
+        try:
+            return pool.map(self.render, config_files)
+        finally:
+            pool.close()
+            pool.join()
 
     def set_release(self, openstack_release):
         """
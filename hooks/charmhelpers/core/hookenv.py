@@ -27,9 +27,14 @@ import yaml
 import subprocess
 import sys
 import errno
+import functools
+import inspect
+import time
 from subprocess import CalledProcessError
 
 import six
+
+from charmhelpers.core import profiler
 if not six.PY3:
     from UserDict import UserDict
 else:
@@ -43,6 +48,74 @@ DEBUG = "DEBUG"
 MARKER = object()
 
 cache = {}
+# Secondary index into cache: (relation id, unit) -> set of cache keys.
+cache_index = {}
+# Per-function cache hit and miss counters.
+cache_stats = {}
+# Prefetched relation settings, keyed by relation id and then by unit.
+relation_snapshots = {}
+# Relation ids known for each relation type, see unitdata.RelationSnapshot.
+relation_id_snapshots = {}
+_prefetch_enabled = False
+_relation_writes = 0
+# Callbacks to run when Hooks.execute completes the current hook, see atexit.
+_atexit = None
+
+_RID_ARGS = ('rid', 'relid', 'relation_id')
+
+
+def _getargspec(func):
+    if six.PY3:
+        spec = inspect.getfullargspec(func)
+    else:
+        spec = inspect.getargspec(func)
+    return spec.args, spec.defaults or ()
+
+
+def _freeze(value):
+    """Return a hashable equivalent of value for use in a cache key"""
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple, set)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+def _cache_key(func, argspec, args, kwargs):
+    """Build a cache key for a call, normalising positional and keyword
+    arguments so that equivalent calls share a key.
+
+    :returns: tuple of (key, bound) where bound maps argument names to
+              their values.
+    """
+    names, defaults = argspec
+    bound = dict(zip(names[len(names) - len(defaults):], defaults))
+    bound.update(zip(names, args))
+    bound.update(kwargs)
+    extra = tuple(args[len(names):])
+    key = (func, tuple(_freeze(bound.get(name)) for name in names),
+           _freeze(extra),
+           _freeze(dict((k, v) for k, v in kwargs.items()
+                        if k not in names)))
+    return key, bound
+
+
+def _cache_scope(bound):
+    """Return the (relation id, unit) pair a cached call is scoped to"""
+    rid = None
+    for name in _RID_ARGS:
+        if isinstance(bound.get(name), six.string_types):
+            rid = bound[name]
+            break
+    if 'unit' not in bound and rid is None:
+        return None
+    rid = rid or relation_id()
+    unit = None
+    if 'unit' in bound:
+        unit = bound['unit'] or os.environ.get('JUJU_REMOTE_UNIT')
+        if not isinstance(unit, six.string_types + (type(None),)):
+            return None
+    return rid, unit
 
 
 def cached(func):
@@ -57,16 +130,35 @@ def cached(func):
         unit_get('test')
 
     will cache the result of unit_get + 'test' for future calls.
+
+    Calls are keyed by function and normalised arguments, so
+    ``relation_get('a', unit='u')`` and ``relation_get('a', 'u')`` share a
+    cache entry. Entries for relation data are indexed by relation id and
+    unit so that :func:`flush_relation` can invalidate them directly.
     """
+    argspec = _getargspec(func)
+
+    @functools.wraps(func)
     def wrapper(*args, **kwargs):
-        global cache
-        key = str((func, args, kwargs))
+        key, bound = _cache_key(func, argspec, args, kwargs)
+        stats = cache_stats.setdefault(func.__name__,
+                                       {'hits': 0, 'misses': 0})
         try:
-            return cache[key]
+            res = cache[key]
         except KeyError:
+            stats['misses'] += 1
             res = func(*args, **kwargs)
             cache[key] = res
+            scope = _cache_scope(bound)
+            if scope is not None:
+                cache_index.setdefault(scope, set()).add(key)
             return res
+        except TypeError:
+            # Unhashable arguments; call through uncached.
+            stats['misses'] += 1
+            return func(*args, **kwargs)
+        stats['hits'] += 1
+        return res
     return wrapper
 
 
@@ -75,12 +167,26 @@ def flush(key):
     key is found in the function+args """
     flush_list = []
     for item in cache:
-        if key in item:
+        if key in str(item):
             flush_list.append(item)
     for item in flush_list:
         del cache[item]
 
 
+def flush_relation(rid, unit):
+    """Flush cached relation data for unit on relation id rid"""
+    for key in cache_index.pop((rid, unit), ()):
+        cache.pop(key, None)
+
+
+def cache_summary():
+    """Return the total number of cache hits and misses for this hook,
+    i.e. how many hook tool invocations were avoided and made."""
+    hits = sum(s['hits'] for s in cache_stats.values())
+    misses = sum(s['misses'] for s in cache_stats.values())
+    return {'hits': hits, 'misses': misses}
+
+
 def log(message, level=None):
     """Write a message to the juju log"""
     command = ['juju-log']
@@ -320,8 +426,9 @@ def config(scope=None):
         config_cmd_line.append(scope)
     config_cmd_line.append('--format=json')
     try:
-        config_data = json.loads(
-            subprocess.check_output(config_cmd_line).decode('UTF-8'))
+        with profiler.timed('config-get'):
+            config_data = json.loads(
+                subprocess.check_output(config_cmd_line).decode('UTF-8'))
         if scope is not None:
             return config_data
         return Config(config_data)
@@ -332,6 +439,16 @@ def config(scope=None):
 @cached
 def relation_get(attribute=None, unit=None, rid=None):
     """Get relation information"""
+    settings = _prefetched_settings(unit, rid)
+    if settings is not MARKER:
+        if attribute is None:
+            return settings
+        return (settings or {}).get(attribute)
+    return _relation_get(attribute, unit, rid)
+
+
+def _relation_get(attribute, unit, rid):
+    """Run the relation-get hook tool"""
     _args = ['relation-get', '--format=json']
     if rid:
         _args.append('-r')
@@ -340,7 +457,8 @@ def relation_get(attribute=None, unit=None, rid=None):
     if unit:
         _args.append(unit)
     try:
-        return json.loads(subprocess.check_output(_args).decode('UTF-8'))
+        with profiler.timed('relation-get'):
+            return json.loads(subprocess.check_output(_args).decode('UTF-8'))
     except ValueError:
         return None
     except CalledProcessError as e:
@@ -349,8 +467,90 @@ def relation_get(attribute=None, unit=None, rid=None):
         raise
 
 
+def relation_prefetch(rid=None):
+    """Fetch the settings of every unit related on a relation id at once
+
+    Each remote unit's settings are read with a single relation-get call and
+    kept in memory, so that subsequent :func:`relation_get` lookups for those
+    units, of single attributes or of all settings, are served without
+    forking further hook tools.
+    Remote settings cannot change during a hook, so the snapshot stays valid
+    until the hook exits.
+
+    :returns: dict mapping unit name to its relation settings.
+    """
+    rid = rid or relation_id()
+    if rid is None:
+        return {}
+    snapshot = {}
+    for unit in related_units(rid):
+        snapshot[unit] = _relation_get(None, unit, rid)
+    relation_snapshots[rid] = snapshot
+    return snapshot
+
+
+def relation_prefetch_mode(enabled=True):
+    """Enable or disable prefetching of relation data
+
+    When enabled, the first lookup for a unit on a relation id that has not
+    been prefetched yet triggers :func:`relation_prefetch` for
+    that relation id.
+    """
+    global _prefetch_enabled
+    _prefetch_enabled = enabled
+
+
+def _prefetched_settings(unit, rid):
+    """Return the prefetched settings for unit on rid, or MARKER if the
+    lookup has to go to the relation-get hook tool."""
+    rid = rid or relation_id()
+    unit = unit or os.environ.get('JUJU_REMOTE_UNIT')
+    if rid is None or unit is None:
+        return MARKER
+    if rid not in relation_snapshots:
+        if not _prefetch_enabled:
+            return MARKER
+        relation_prefetch(rid)
+    return relation_snapshots[rid].get(unit, MARKER)
+
+
+def atexit(callback, *args, **kwargs):
+    """Schedule a callback to run once the current hook completes
+
+    Callbacks are run by :meth:`Hooks.execute` after the hook function has
+    returned successfully, in the order they were first scheduled. Scheduling
+    the same callback with the same arguments again has no effect.
+
+    :returns: True if the callback was scheduled, False if no hook is being
+              executed by :class:`Hooks`, in which case the caller is
+              responsible for running it.
+    """
+    if _atexit is None:
+        return False
+    entry = (callback, args, kwargs)
+    if entry not in _atexit:
+        _atexit.append(entry)
+    return True
+
+
+def _run_atexit():
+    """Run the callbacks scheduled with :func:`atexit`"""
+    i = 0
+    # Callbacks may schedule further callbacks
+    while i < len(_atexit):
+        callback, args, kwargs = _atexit[i]
+        callback(*args, **kwargs)
+        i += 1
+
+
+def relation_writes():
+    """Return the number of relation_set calls made so far in this hook"""
+    return _relation_writes
+
+
 def relation_set(relation_id=None, relation_settings=None, **kwargs):
     """Set relation information for the current unit"""
+    global _relation_writes
     relation_settings = relation_settings if relation_settings else {}
     relation_cmd_line = ['relation-set']
     if relation_id is not None:
@@ -360,20 +560,26 @@ def relation_set(relation_id=None, relation_settings=None, **kwargs):
             relation_cmd_line.append('{}='.format(k))
         else:
             relation_cmd_line.append('{}={}'.format(k, v))
-    subprocess.check_call(relation_cmd_line)
+    with profiler.timed('relation-set'):
+        subprocess.check_call(relation_cmd_line)
     # Flush cache of any relation-gets for local unit
-    flush(local_unit())
+    flush_relation(relation_id or os.environ.get('JUJU_RELATION_ID'),
+                   local_unit())
+    _relation_writes += 1
 
 
 @cached
 def relation_ids(reltype=None):
     """A list of relation_ids"""
     reltype = reltype or relation_type()
+    if reltype in relation_id_snapshots:
+        return list(relation_id_snapshots[reltype])
     relid_cmd_line = ['relation-ids', '--format=json']
     if reltype is not None:
         relid_cmd_line.append(reltype)
-        return json.loads(
-            subprocess.check_output(relid_cmd_line).decode('UTF-8')) or []
+        with profiler.timed('relation-ids'):
+            return json.loads(
+                subprocess.check_output(relid_cmd_line).decode('UTF-8')) or []
     return []
 
 
@@ -381,11 +587,14 @@ def relation_ids(reltype=None):
 def related_units(relid=None):
     """A list of related units"""
     relid = relid or relation_id()
+    if relid in relation_snapshots:
+        return sorted(relation_snapshots[relid])
     units_cmd_line = ['relation-list', '--format=json']
     if relid is not None:
         units_cmd_line.extend(('-r', relid))
-    return json.loads(
-        subprocess.check_output(units_cmd_line).decode('UTF-8')) or []
+    with profiler.timed('relation-list'):
+        return json.loads(
+            subprocess.check_output(units_cmd_line).decode('UTF-8')) or []
 
 
 @cached
@@ -489,7 +698,8 @@ def open_port(port, protocol="TCP"):
     """Open a service network port"""
     _args = ['open-port']
     _args.append('{}/{}'.format(port, protocol))
-    subprocess.check_call(_args)
+    with profiler.timed('open-port'):
+        subprocess.check_call(_args)
 
 
 def close_port(port, protocol="TCP"):
@@ -504,7 +714,8 @@ def unit_get(attribute):
     """Get the unit ID for the remote unit"""
     _args = ['unit-get', '--format=json', attribute]
     try:
-        return json.loads(subprocess.check_output(_args).decode('UTF-8'))
+        with profiler.timed('unit-get'):
+            return json.loads(subprocess.check_output(_args).decode('UTF-8'))
     except ValueError:
         return None
 
@@ -552,16 +763,34 @@ class Hooks(object):
 
     def execute(self, args):
         """Execute a registered hook based on args[0]"""
+        global _atexit
         hook_name = os.path.basename(args[0])
         if hook_name in self._hooks:
-            self._hooks[hook_name]()
-            if self._config_save:
-                cfg = config()
-                if cfg.implicit_save:
-                    cfg.save()
+            start = time.time()
+            _atexit = []
+            try:
+                self._hooks[hook_name]()
+                if self._config_save:
+                    cfg = config()
+                    if cfg.implicit_save:
+                        cfg.save()
+                _run_atexit()
+            finally:
+                _atexit = None
+                if profiler.enabled():
+                    self._report_profile(hook_name, time.time() - start)
         else:
             raise UnregisteredHookError(hook_name)
 
+    def _report_profile(self, hook_name, elapsed):
+        """Log the profile of the hook just executed and keep it in unitdata"""
+        data = profiler.summary(hook_name, elapsed, cache_stats)
+        log(profiler.format_summary(data), level=DEBUG)
+        try:
+            profiler.persist(data)
+        except Exception as e:
+            log('Unable to persist hook profile: %s' % e, level=WARNING)
+
     def hook(self, *hook_names):
         """Decorator, registering them as hooks"""
         def wrapper(decorated):
@@ -29,14 +29,30 @@ import random
 import string
 import subprocess
 import hashlib
+import time
 from contextlib import contextmanager
 from collections import OrderedDict
 
 import six
 
-from .hookenv import log
+from . import profiler
+from .hookenv import atexit, log, DEBUG
 from .fstab import Fstab
 
+# Service actions queued during the current hook, see restart_on_change:
+# service name -> [action, restart_on_failure], in order of first request.
+_pending_restarts = OrderedDict()
+# Precedence of queued actions; a service gets the strongest one requested.
+_RESTART_PRECEDENCE = {'reload': 0, 'restart': 1, 'stopstart': 2}
+# Depth of nested restart_on_change decorated calls.
+_restart_depth = 0
+# Declared ordering of service actions: service -> services acted on first.
+_service_ordering = {}
+
+# Seconds to wait for a batch of service actions to complete.
+SERVICE_TIMEOUT = 300
+SERVICE_POLL_INTERVAL = 0.1
+
 
 def service_start(service_name):
     """Start a system service"""
@@ -49,13 +65,25 @@ def service_stop(service_name):
 
 
 def service_restart(service_name):
-    """Restart a system service"""
+    """Restart a system service
+
+    Inside a hook run by :class:`charmhelpers.core.hookenv.Hooks` or a
+    function decorated with :func:`restart_on_change`, the restart is queued
+    and True is returned; see :func:`schedule_service_action`.
+    """
+    if schedule_service_action(service_name, 'restart'):
+        return True
     return service('restart', service_name)
 
 
 def service_reload(service_name, restart_on_failure=False):
     """Reload a system service, optionally falling back to restart if
-    reload fails"""
+    reload fails
+
+    Queued like :func:`service_restart` when inside a hook.
+    """
+    if schedule_service_action(service_name, 'reload', restart_on_failure):
+        return True
     service_result = service('reload', service_name)
     if not service_result and restart_on_failure:
         service_result = service('restart', service_name)
@@ -65,7 +93,158 @@ def service_reload(service_name, restart_on_failure=False):
 def service(action, service_name):
     """Control a system service"""
     cmd = ['service', service_name, action]
-    return subprocess.call(cmd) == 0
+    with profiler.timed('service %s' % action):
+        return subprocess.call(cmd) == 0
+
+
+def schedule_service_action(service_name, action,
+                            restart_on_failure=False):
+    """Queue a 'reload', 'restart' or 'stopstart' of a service.
+
+    Queued actions are run once per service by :func:`flush_restarts`, at
+    the end of the hook when running under
+    :class:`charmhelpers.core.hookenv.Hooks`, or otherwise when the
+    outermost :func:`restart_on_change` decorated call returns. A service
+    requested several times gets the strongest action asked for, so it is
+    restarted at most once per hook.
+
+    :returns: True if the action was queued, False if there is no hook or
+              decorated call to defer it to and the caller must run it.
+    """
+    if not atexit(flush_restarts) and not _restart_depth:
+        return False
+    pending = _pending_restarts.get(service_name)
+    if pending is None:
+        _pending_restarts[service_name] = [action, restart_on_failure]
+    else:
+        if _RESTART_PRECEDENCE[action] > _RESTART_PRECEDENCE[pending[0]]:
+            pending[0] = action
+        pending[1] = pending[1] or restart_on_failure
+    return True
+
+
+def declare_service_ordering(ordering):
+    """Declare services that must be acted on before others.
+
+    :param ordering: dict mapping a service name to the list of services
+                     whose restart, reload or start must complete before its
+                     own; stops happen in the reverse order.
+    """
+    for service_name, after in six.iteritems(ordering):
+        deps = _service_ordering.setdefault(service_name, [])
+        deps.extend(s for s in after if s not in deps)
+
+
+def _service_levels(service_names, ordering):
+    """Group service_names into levels such that every service comes after
+    the services it is ordered after. Services in a level are independent.
+    """
+    levels = {}
+
+    def level(service_name, visiting):
+        if service_name in levels:
+            return levels[service_name]
+        visiting.add(service_name)
+        result = 0
+        for dep in ordering.get(service_name, []):
+            if dep not in service_names:
+                continue
+            if dep in visiting:
+                log('Ignoring cyclic ordering of {} after {}'.format(
+                    service_name, dep))
+                continue
+            result = max(result, level(dep, visiting) + 1)
+        visiting.discard(service_name)
+        levels[service_name] = result
+        return result
+
+    grouped = []
+    for service_name in service_names:
+        n = level(service_name, set())
+        while len(grouped) <= n:
+            grouped.append([])
+        grouped[n].append(service_name)
+    return [g for g in grouped if g]
+
+
+def service_actions(actions, ordering=None, reverse=False,
+                    timeout=SERVICE_TIMEOUT):
+    """Run service actions concurrently, respecting a declared ordering.
+
+    Services that do not depend on each other are acted on at the same time,
+    one level of the ordering after another. Each level is waited on for at
+    most timeout seconds; services still running their action after that are
+    killed and reported as failed, as are all services of later levels.
+
+    :param actions: list of (service name, action) pairs.
+    :param ordering: dict as taken by :func:`declare_service_ordering`,
+                     defaults to the ordering declared so far.
+    :param reverse: act on the levels in reverse order, as when stopping.
+    :returns: OrderedDict mapping service name to whether its action
+              succeeded, in the order of actions.
+    """
+    if ordering is None:
+        ordering = _service_ordering
+    actions = OrderedDict(actions)
+    levels = _service_levels(list(actions), ordering)
+    if reverse:
+        levels.reverse()
+    outcomes = {}
+    timed_out = False
+    for services in levels:
+        if timed_out:
+            outcomes.update((name, False) for name in services)
+            continue
+        deadline = time.time() + timeout
+        with profiler.timed('service batch'):
+            procs = dict((name, subprocess.Popen(
+                ['service', name, actions[name]])) for name in services)
+            while procs and time.time() < deadline:
+                for name, proc in list(procs.items()):
+                    if proc.poll() is not None:
+                        outcomes[name] = proc.returncode == 0
+                        del procs[name]
+                if procs:
+                    time.sleep(SERVICE_POLL_INTERVAL)
+        for name, proc in six.iteritems(procs):
+            timed_out = True
+            log('Timed out after {}s waiting for {} {}'.format(
+                timeout, actions[name], name))
+            proc.kill()
+            proc.wait()
+            outcomes[name] = False
+    results = OrderedDict((name, outcomes[name]) for name in actions)
+    for name, result in six.iteritems(results):
+        if not result:
+            log('Failed to {} {}'.format(actions[name], name))
+    return results
+
+
+def flush_restarts():
+    """Run the queued service actions.
+
+    Services to be stopped and started are all stopped first, in reverse
+    dependency order, and then started along with the restarts and reloads
+    of the other services; see :func:`service_actions`.
+
+    :returns: dict mapping service name to whether its action succeeded.
+    """
+    pending = list(_pending_restarts.items())
+    _pending_restarts.clear()
+    stops = [(service_name, 'stop') for service_name, (action, _) in pending
+             if action == 'stopstart']
+    if stops:
+        service_actions(stops, reverse=True)
+    results = service_actions(
+        [(service_name, 'start' if action == 'stopstart' else action)
+         for service_name, (action, _) in pending])
+    fallback = [(service_name, 'restart')
+                for service_name, (action, restart_on_failure) in pending
+                if action == 'reload' and restart_on_failure and
+                not results[service_name]]
+    if fallback:
+        results.update(service_actions(fallback))
+    return results
 
 
 def service_running(service):
@@ -253,20 +432,59 @@ def mounts():
     return system_mounts
 
 
+# Digest used to detect that a file changed, as opposed to verifying its
+# integrity. md5 hashes faster than sha1 or blake2b; unchanged files are not
+# hashed again at all, see file_hash.
+CHANGE_HASH = 'md5'
+# Size of the chunks files are hashed in.
+HASH_CHUNK_SIZE = 65536
+
+# Known digests: (path, hash_type) -> (stat fingerprint, digest)
+_file_digests = {}
+
+
+def _stat_fingerprint(path):
+    st = os.stat(path)
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(st.st_mtime * 1000000000)
+    return (st.st_dev, st.st_ino, st.st_size, mtime_ns)
+
+
+def record_file_hash(path, digest, hash_type='md5'):
+    """
+    Record the digest of the content that was just written to 'path', so
+    that :func:`file_hash` can return it without reading the file back for
+    as long as the file is not modified.
+    """
+    _file_digests[(path, hash_type)] = (_stat_fingerprint(path), digest)
+
+
 def file_hash(path, hash_type='md5'):
     """
     Generate a hash checksum of the contents of 'path' or None if not found.
 
+    Digests are remembered along with the inode, size and modification time
+    of the file, and reused for as long as those do not change.
+
     :param str hash_type: Any hash alrgorithm supported by :mod:`hashlib`,
-                          such as md5, sha1, sha256, sha512, etc.
+                          such as md5, sha1, sha256, sha512, etc. Use
+                          :data:`CHANGE_HASH` to only detect changes.
     """
-    if os.path.exists(path):
-        h = getattr(hashlib, hash_type)()
-        with open(path, 'rb') as source:
-            h.update(source.read())
-        return h.hexdigest()
-    else:
+    try:
+        fingerprint = _stat_fingerprint(path)
+    except OSError:
         return None
+    known = _file_digests.get((path, hash_type))
+    if known and known[0] == fingerprint:
+        return known[1]
+    h = getattr(hashlib, hash_type)()
+    with open(path, 'rb') as source:
+        for chunk in iter(lambda: source.read(HASH_CHUNK_SIZE), b''):
+            h.update(chunk)
+    digest = h.hexdigest()
+    _file_digests[(path, hash_type)] = (fingerprint, digest)
+    return digest
 
 
 def check_hash(path, checksum, hash_type='md5'):
@@ -289,6 +507,66 @@ class ChecksumError(ValueError):
     pass
 
 
+def ini_sections(path):
+    """Parse the INI file at path into a dict mapping each section name to
+    a dict of its options, or return an empty dict if the file cannot be
+    read.
+
+    Only what a consumer of the file would see is kept: comments, blank
+    lines and whitespace around names and values are dropped, and indented
+    continuation lines are folded into the value they continue. Options are
+    mapped to the list of their values, since options repeated within a
+    section are multi-valued. Options preceding the first section header are
+    kept under ''.
+    """
+    try:
+        with open(path, 'rb') as f:
+            content = f.read().decode('UTF-8', 'replace')
+    except (IOError, OSError):
+        return {}
+    sections = {}
+    options = sections.setdefault('', {})
+    values = None
+    for line in content.splitlines():
+        stripped = line.strip()
+        if not stripped or stripped[0] in '#;':
+            continue
+        if line[0].isspace() and values:
+            values[-1] = '{} {}'.format(values[-1], stripped)
+            continue
+        if stripped.startswith('[') and stripped.endswith(']'):
+            options = sections.setdefault(stripped[1:-1].strip(), {})
+            values = None
+            continue
+        name, sep, value = stripped.partition('=')
+        if not sep:
+            name, sep, value = stripped.partition(':')
+        values = options.setdefault(name.strip(), [])
+        values.append(value.strip())
+    if not sections['']:
+        del sections['']
+    return sections
+
+
+def changed_sections(before, after):
+    """Return the set of sections that differ between two results of
+    :func:`ini_sections`, including added and removed ones."""
+    return set(name for name in set(before) | set(after)
+               if before.get(name) != after.get(name))
+
+
+def _service_actions(services):
+    """Return the (service, action) pairs of a restart_map value"""
+    if isinstance(services, dict):
+        return list(services.items())
+    return [(service_name, 'restart') for service_name in services]
+
+
+def _watches_sections(services):
+    return any(isinstance(action, (list, tuple))
+               for _, action in _service_actions(services))
+
+
 def restart_on_change(restart_map, stopstart=False):
     """Restart services based on configuration files changing
 
@@ -303,25 +581,70 @@ def restart_on_change(restart_map, stopstart=False):
     In this example, the cinder-api and cinder-volume services
     would be restarted if /etc/ceph/ceph.conf is changed by the
     ceph_client_changed function.
+
+    A file may instead map to a dict of service to action, where the action
+    is 'restart', 'reload', or a list of INI sections of the file, in which
+    case the service is restarted only if one of those sections changed
+    (see :func:`ini_sections`). Changes to such a file that do not change
+    any section, such as whitespace or comments, act on no service::
+
+        @restart_on_change({
+            '/etc/cinder/cinder.conf': {
+                'cinder-api': 'restart',
+                'cinder-volume': ['DEFAULT', 'database'],
+            },
+            '/etc/haproxy/haproxy.cfg': {'haproxy': 'reload'},
+            })
+
+    Services whose reload fails, for instance because they are not running,
+    are restarted instead. With stopstart, restarts are done as a stop
+    followed by a start.
+
+    Restarts are queued with :func:`schedule_service_action`, so that
+    nested or repeated decorated calls, and direct service_restart or
+    service_reload calls, restart each service at most once per hook.
+    Independent services are restarted concurrently, in the order declared
+    with :func:`declare_service_ordering`.
     """
     def wrap(f):
         def wrapped_f(*args, **kwargs):
+            global _restart_depth
             checksums = {}
+            sections = {}
             for path in restart_map:
-                checksums[path] = file_hash(path)
-            f(*args, **kwargs)
-            restarts = []
-            for path in restart_map:
-                if checksums[path] != file_hash(path):
-                    restarts += restart_map[path]
-            services_list = list(OrderedDict.fromkeys(restarts))
-            if not stopstart:
-                for service_name in services_list:
-                    service('restart', service_name)
-            else:
-                for action in ['stop', 'start']:
-                    for service_name in services_list:
-                        service(action, service_name)
+                checksums[path] = file_hash(path, CHANGE_HASH)
+                if _watches_sections(restart_map[path]):
+                    sections[path] = ini_sections(path)
+            _restart_depth += 1
+            try:
+                f(*args, **kwargs)
+                for path in restart_map:
+                    if checksums[path] == file_hash(path, CHANGE_HASH):
+                        continue
+                    if path in sections:
+                        changed = changed_sections(sections[path],
+                                                   ini_sections(path))
+                        if not changed:
+                            log('Skipping restarts for {}: no semantic '
+                                'change'.format(path), level=DEBUG)
+                            continue
+                    for service_name, action in \
+                            _service_actions(restart_map[path]):
+                        if isinstance(action, (list, tuple)):
+                            if not changed.intersection(action):
+                                continue
+                            action = 'restart'
+                        if action == 'restart' and stopstart:
+                            action = 'stopstart'
+                        # Reloading a stopped service fails, restarting it
+                        # starts it as a plain restart would have done
+                        schedule_service_action(
+                            service_name, action,
+                            restart_on_failure=action == 'reload')
+            finally:
+                _restart_depth -= 1
+            if not _restart_depth and not atexit(flush_restarts):
+                flush_restarts()
         return wrapped_f
     return wrap
 
@@ -0,0 +1,190 @@
+# Copyright 2014-2015 Canonical Limited.
+#
+# This file is part of charm-helpers.
+#
+# charm-helpers is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License version 3 as
+# published by the Free Software Foundation.
+#
+# charm-helpers is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with charm-helpers.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Timing of hook tool invocations and other expensive hook operations.
+
+Profiling is disabled by default and costs a single flag check per
+instrumented call. A charm enables it from its main block::
+
+    from charmhelpers.core import profiler
+
+    if __name__ == '__main__':
+        profiler.enable()
+        hooks.execute(sys.argv)
+
+Once enabled, hook tools, service control, apt commands, template rendering
+and context generators record their call counts and wall time, along with
+the context generator that was being evaluated when they were called. When
+:meth:`charmhelpers.core.hookenv.Hooks.execute` finishes, whether or not the
+hook failed, a summary is logged and appended to the ``profiler.hooks`` key of
+the unit's key value store so that it can be trended across hook executions.
+"""
+
+import contextlib
+import functools
+import threading
+import time
+
+__author__ = 'Charm Helpers Developers <juju@lists.ubuntu.com>'
+
+# Number of hook summaries kept in unitdata
+HISTORY = 50
+KV_KEY = 'profiler.hooks'
+
+_enabled = False
+_lock = threading.Lock()
+_local = threading.local()
+# operation name -> {'calls': int, 'time': float, 'contexts': {name: calls}}
+_stats = {}
+
+
+def enable(enabled=True):
+    """Turn profiling on or off for the remainder of the process"""
+    global _enabled
+    _enabled = enabled
+
+
+def enabled():
+    """Return True if profiling is turned on"""
+    return _enabled
+
+
+def reset():
+    """Discard everything recorded so far"""
+    with _lock:
+        _stats.clear()
+
+
+def _context_stack():
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def current_context():
+    """Return the name of the context generator being evaluated by the
+    calling thread, or None."""
+    stack = _context_stack()
+    return stack[-1] if stack else None
+
+
+def record(name, elapsed, context=None):
+    """Record a single call of operation name that took elapsed seconds"""
+    with _lock:
+        entry = _stats.setdefault(name, {'calls': 0, 'time': 0.0,
+                                         'contexts': {}})
+        entry['calls'] += 1
+        entry['time'] += elapsed
+        if context is not None:
+            entry['contexts'][context] = entry['contexts'].get(context, 0) + 1
+
+
+@contextlib.contextmanager
+def timed(name):
+    """Time the enclosed block as one call of operation name"""
+    if not _enabled:
+        yield
+        return
+    context = current_context()
+    start = time.time()
+    try:
+        yield
+    finally:
+        record(name, time.time() - start, context)
+
+
+def profiled(name):
+    """Decorator timing each call of the decorated function as name"""
+    def wrapper(func):
+        @functools.wraps(func)
+        def wrapped(*args, **kwargs):
+            with timed(name):
+                return func(*args, **kwargs)
+        return wrapped
+    return wrapper
+
+
+@contextlib.contextmanager
+def context(name):
+    """Mark the enclosed block as the evaluation of context generator name.
+
+    Operations timed inside the block are attributed to it, and the block
+    itself is timed as ``context <name>``.
+    """
+    if not _enabled:
+        yield
+        return
+    stack = _context_stack()
+    stack.append(name)
+    try:
+        with timed('context %s' % name):
+            yield
+    finally:
+        stack.pop()
+
+
+def summary(hook_name=None, elapsed=None, cache_stats=None):
+    """Return a json serialisable summary of what has been recorded.
+
+    :param hook_name: name of the hook being profiled
+    :param elapsed: total wall time of the hook in seconds
+    :param cache_stats: hit and miss counts of cached functions, as kept by
+                        :data:`charmhelpers.core.hookenv.cache_stats`
+    """
+    with _lock:
+        operations = dict((name, {'calls': entry['calls'],
+                                  'time': round(entry['time'], 6),
+                                  'contexts': dict(entry['contexts'])})
+                          for name, entry in _stats.items())
+    return {
+        'hook': hook_name,
+        'time': round(elapsed, 6) if elapsed is not None else None,
+        'timestamp': time.time(),
+        'operations': operations,
+        'cache': dict((name, dict(counts))
+                      for name, counts in (cache_stats or {}).items()),
+    }
+
+
+def format_summary(data):
+    """Return a human readable report of a summary"""
+    lines = ['Profile of hook %s: %.3fs' % (data['hook'], data['time'] or 0)]
+    operations = sorted(data['operations'].items(),
+                        key=lambda item: item[1]['time'], reverse=True)
+    for name, entry in operations:
+        line = '  %-40s %5d calls %9.3fs' % (name, entry['calls'],
+                                             entry['time'])
+        if entry['contexts']:
+            line += ' (%s)' % ', '.join(
+                '%s: %d' % c for c in sorted(entry['contexts'].items()))
+        lines.append(line)
+    for name, counts in sorted(data['cache'].items()):
+        lines.append('  cache %-34s %5d hits %6d misses' %
+                     (name, counts.get('hits', 0), counts.get('misses', 0)))
+    return '\n'.join(lines)
+
+
+def persist(data, kv=None):
+    """Append a summary to the unit's key value store, keeping the last
+    HISTORY entries."""
+    if kv is None:
+        from charmhelpers.core import unitdata
+        kv = unitdata.kv()
+    history = kv.get(KV_KEY) or []
+    history.append(data)
+    kv.set(KV_KEY, history[-HISTORY:])
+    kv.flush()
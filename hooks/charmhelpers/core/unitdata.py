@@ -449,6 +449,105 @@ class HookData(object):
         return conf_delta, rels_delta
 
 
+class RelationSnapshot(object):
+    """Persist the settings of all related units across hook executions.
+
+    At the end of each hook the relation ids of every relation type and the
+    settings of every remote unit are stored in the unit's kv store. The
+    next hook loads that snapshot into :mod:`hookenv` and only refreshes the
+    relation named by ``JUJU_RELATION_ID``: its unit list, the settings of
+    ``JUJU_REMOTE_UNIT`` and of any newly joined unit. Departed units and
+    broken relations are dropped. :func:`hookenv.relation_ids`,
+    :func:`hookenv.related_units` and :func:`hookenv.relation_get` are then
+    answered from memory for everything else.
+
+    Remote units always trigger a relation-changed hook when their settings
+    change, so the snapshot only lags behind for the hooks queued before that
+    one has run.
+
+    Sample::
+
+       from charmhelpers.core import hookenv, unitdata
+
+       hooks = hookenv.Hooks()
+
+       if __name__ == '__main__':
+           with unitdata.RelationSnapshot():
+               hooks.execute(sys.argv)
+
+    The snapshot is only saved when the block completes without raising.
+
+    """
+    KEY = 'relation-snapshot'
+    # Hooks after which the relations known to the charm may have changed
+    # without a relation hook; these rebuild the snapshot from scratch.
+    FULL_REFRESH_HOOKS = ('install', 'upgrade-charm')
+
+    def __init__(self):
+        self.kv = kv()
+
+    def __enter__(self):
+        from charmhelpers.core import hookenv
+        self.load(hookenv)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            from charmhelpers.core import hookenv
+            self.save(hookenv)
+
+    def load(self, hookenv):
+        snapshot = self.kv.get(self.KEY)
+        if snapshot is None or hookenv.hook_name() in self.FULL_REFRESH_HOOKS:
+            ids, units = self._fetch_all(hookenv)
+        else:
+            ids, units = snapshot['ids'], snapshot['units']
+            self._refresh_current(hookenv, ids, units)
+        hookenv.relation_id_snapshots.update(ids)
+        hookenv.relation_snapshots.update(units)
+
+    def save(self, hookenv):
+        self.kv.set(self.KEY, {'ids': hookenv.relation_id_snapshots,
+                               'units': hookenv.relation_snapshots})
+        self.kv.flush()
+
+    def _fetch_all(self, hookenv):
+        ids = {}
+        units = {}
+        for reltype in hookenv.relation_types():
+            ids[reltype] = hookenv.relation_ids(reltype)
+            for rid in ids[reltype]:
+                units[rid] = self._fetch_units(hookenv, rid, {})
+        return ids, units
+
+    def _refresh_current(self, hookenv, ids, units):
+        reltype = hookenv.relation_type()
+        rid = hookenv.relation_id()
+        if rid is None:
+            return
+        ids[reltype] = hookenv.relation_ids(reltype)
+        if hookenv.hook_name().endswith('-relation-broken'):
+            if rid in ids[reltype]:
+                ids[reltype].remove(rid)
+            units.pop(rid, None)
+            return
+        known = dict(units.get(rid, {}))
+        known.pop(os.environ.get('JUJU_REMOTE_UNIT'), None)
+        units[rid] = self._fetch_units(hookenv, rid, known)
+
+    def _fetch_units(self, hookenv, rid, known):
+        """Return settings for the units related on rid, reusing the ones
+        in known and fetching the rest."""
+        settings = {}
+        for unit in hookenv.related_units(rid):
+            if unit in known:
+                settings[unit] = known[unit]
+            else:
+                settings[unit] = hookenv.relation_get(unit=unit,
+                                                      rid=rid) or {}
+        return settings
+
+
 class Record(dict):
 
     __slots__ = ()
@@ -14,18 +14,28 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with charm-helpers.  If not, see <http://www.gnu.org/licenses/>.
 
+import errno
+import fcntl
+import glob
+import hashlib
 import importlib
+import struct
+from contextlib import contextmanager
 from tempfile import NamedTemporaryFile
 import time
 from yaml import safe_load
 from charmhelpers.core.host import (
-    lsb_release
+    file_hash,
+    lsb_release,
+    CHANGE_HASH,
 )
 import subprocess
 from charmhelpers.core.hookenv import (
+    charm_dir,
     config,
     log,
 )
+from charmhelpers.core import profiler, unitdata
 import os
 
 import six
@@ -103,6 +113,41 @@ FETCH_HANDLERS = (
 APT_NO_LOCK = 100  # The return code for "couldn't acquire lock" in APT.
 APT_NO_LOCK_RETRY_DELAY = 10  # Wait 10 seconds between apt lock checks.
 APT_NO_LOCK_RETRY_COUNT = 30  # Retry to acquire the lock X times.
+# Overall time apt commands wait for the dpkg lock.
+APT_LOCK_TIMEOUT = APT_NO_LOCK_RETRY_DELAY * APT_NO_LOCK_RETRY_COUNT
+# Bounds of the backoff between probes of the dpkg lock, in seconds.
+APT_LOCK_POLL_MIN = 0.1
+APT_LOCK_POLL_MAX = 2
+# Locks taken by dpkg and apt, of which only existing ones are waited on.
+APT_LOCKS = (
+    '/var/lib/dpkg/lock-frontend',
+    '/var/lib/dpkg/lock',
+    '/var/lib/apt/lists/lock',
+)
+# struct flock: l_type, l_whence, l_start, l_len, l_pid
+_FLOCK_FORMAT = 'hhqqi'
+
+# apt_pkg caches shared within the process, keyed by in_memory; see apt_cache.
+_apt_caches = {}
+
+# Files whose content determines the result of apt-get update.
+APT_SOURCES = (
+    '/etc/apt/sources.list',
+    '/etc/apt/sources.list.d/*',
+    '/etc/apt/trusted.gpg',
+    '/etc/apt/trusted.gpg.d/*',
+)
+# unitdata key recording the sources and time of the last apt-get update.
+APT_UPDATE_KEY = 'fetch.apt-update'
+# Seconds for which package lists are reused when sources are unchanged.
+APT_UPDATE_MAX_AGE = 4 * 60 * 60
+
+DPKG_STATUS = '/var/lib/dpkg/status'
+# unitdata key of the installed package index, see package_index.
+PACKAGE_INDEX_KEY = 'fetch.package-index'
+# dpkg states in which a package has no installed version.
+DPKG_NOT_INSTALLED = ('not-installed', 'config-files')
+_package_index = None
 
 
 class SourceConfigError(Exception):
@@ -157,13 +202,118 @@ def filter_installed_packages(packages):
 
 
 def apt_cache(in_memory=True):
-    """Build and return an apt cache"""
-    import apt_pkg
-    apt_pkg.init()
-    if in_memory:
-        apt_pkg.config.set("Dir::Cache::pkgcache", "")
-        apt_pkg.config.set("Dir::Cache::srcpkgcache", "")
-    return apt_pkg.Cache()
+    """Build and return an apt cache
+
+    The cache is built once per process and shared by every caller until
+    :func:`invalidate_apt_cache` is called, which the apt commands run by
+    this module do once they complete.
+    """
+    if in_memory not in _apt_caches:
+        import apt_pkg
+        apt_pkg.init()
+        if in_memory:
+            apt_pkg.config.set("Dir::Cache::pkgcache", "")
+            apt_pkg.config.set("Dir::Cache::srcpkgcache", "")
+        _apt_caches[in_memory] = apt_pkg.Cache()
+    return _apt_caches[in_memory]
+
+
+def invalidate_apt_cache():
+    """Discard the apt cache shared by :func:`apt_cache` callers"""
+    _apt_caches.clear()
+
+
+def parse_dpkg_status(path=DPKG_STATUS):
+    """Parse the dpkg status file
+
+    :returns: dict mapping the name of each installed package to a dict with
+              its 'version' and whether it is on 'hold'.
+    """
+    packages = {}
+    fields = {}
+    with open(path) as status:
+        for line in status:
+            if not line.strip():
+                _index_package(packages, fields)
+                fields = {}
+            elif not line[0].isspace():
+                name, _, value = line.partition(':')
+                if name in ('Package', 'Status', 'Version'):
+                    fields[name] = value.strip()
+    _index_package(packages, fields)
+    return packages
+
+
+def _index_package(packages, fields):
+    state = fields.get('Status', '').split()
+    if len(state) != 3 or state[2] in DPKG_NOT_INSTALLED:
+        return
+    # Keep the first architecture of multi-arch packages
+    packages.setdefault(fields['Package'], {
+        'version': fields.get('Version'),
+        'hold': state[0] == 'hold',
+    })
+
+
+def _dpkg_status_fingerprint():
+    st = os.stat(DPKG_STATUS)
+    return [st.st_ino, st.st_size, st.st_mtime]
+
+
+def package_index(refresh=False):
+    """Return the index of installed packages built by
+    :func:`parse_dpkg_status`.
+
+    The index is kept in the unit's key value store along with the inode,
+    size and modification time of the dpkg status file it was built from,
+    and only rebuilt when those change, so that looking up installed versions
+    needs neither an apt cache nor a parse of the status file on most hooks.
+    Package changing operations of this module refresh it once they
+    complete.
+    """
+    global _package_index
+    try:
+        fingerprint = _dpkg_status_fingerprint()
+    except OSError as e:
+        log('Unable to read {}: {}'.format(DPKG_STATUS, e), level='WARNING')
+        return {}
+    if not refresh and _package_index is None and charm_dir():
+        _package_index = unitdata.kv().get(PACKAGE_INDEX_KEY)
+    if (refresh or _package_index is None or
+            _package_index['fingerprint'] != fingerprint):
+        _package_index = {'fingerprint': fingerprint,
+                          'packages': parse_dpkg_status(DPKG_STATUS)}
+        if charm_dir():
+            kv = unitdata.kv()
+            kv.set(PACKAGE_INDEX_KEY, _package_index)
+            kv.flush()
+    return _package_index['packages']
+
+
+def installed_version(package):
+    """Return the installed version of package, or None if not installed"""
+    return package_index().get(package, {}).get('version')
+
+
+def upstream_version(version):
+    """Return the upstream part of a Debian version string, without its
+    epoch and Debian revision, as apt_pkg.upstream_version does."""
+    if ':' in version:
+        version = version.split(':', 1)[1]
+    if '-' in version:
+        version = version.rsplit('-', 1)[0]
+    return version
+
+
+def _packages_changed():
+    """Drop package state cached in this process after apt or dpkg ran"""
+    invalidate_apt_cache()
+    if _package_index is not None:
+        try:
+            package_index(refresh=True)
+        except (IOError, OSError) as e:
+            log('Unable to refresh the installed package index: '
+                '{}'.format(e), level='WARNING')
 
 
 def apt_install(packages, options=None, fatal=False):
@@ -198,10 +348,41 @@ def apt_upgrade(options=None, fatal=False, dist=False):
     _run_apt_command(cmd, fatal)
 
 
-def apt_update(fatal=False):
-    """Update local apt cache"""
+def _apt_sources_fingerprint():
+    """Return a digest of the apt sources and keyrings"""
+    h = hashlib.sha1()
+    for pattern in APT_SOURCES:
+        for path in sorted(glob.glob(pattern)):
+            if os.path.isfile(path):
+                h.update('{}={}\n'.format(
+                    path, file_hash(path, CHANGE_HASH)).encode('UTF-8'))
+    return h.hexdigest()
+
+
+def apt_update(fatal=False, max_age=None):
+    """Update local apt cache
+
+    The update is skipped if the apt sources and keyrings are unchanged
+    since the last successful update run through this function, and that
+    update is less than max_age seconds old.
+
+    :param max_age: seconds, defaults to APT_UPDATE_MAX_AGE; 0 always
+                    updates.
+    """
+    if max_age is None:
+        max_age = APT_UPDATE_MAX_AGE
+    sources = _apt_sources_fingerprint()
+    kv = unitdata.kv() if charm_dir() else None
+    last = kv.get(APT_UPDATE_KEY) if kv else None
+    if (last and last['sources'] == sources and
+            0 <= time.time() - last['time'] < max_age):
+        log('apt sources unchanged since the update {:.0f}s ago, not '
+            'updating'.format(time.time() - last['time']))
+        return
     cmd = ['apt-get', 'update']
-    _run_apt_command(cmd, fatal)
+    if _run_apt_command(cmd, fatal) == 0 and kv:
+        kv.set(APT_UPDATE_KEY, {'sources': sources, 'time': time.time()})
+        kv.flush()
 
 
 def apt_purge(packages, fatal=False):
@@ -224,10 +405,130 @@ def apt_hold(packages, fatal=False):
         cmd.extend(packages)
     log("Holding {}".format(packages))
 
-    if fatal:
-        subprocess.check_call(cmd)
-    else:
-        subprocess.call(cmd)
+    try:
+        wait_for_dpkg_lock()
+        if fatal:
+            subprocess.check_call(cmd)
+        else:
+            subprocess.call(cmd)
+    finally:
+        _packages_changed()
+
+
+def _apt_upgrade_takes_packages():
+    """apt-get accepts packages to install along with upgrade and
+    dist-upgrade from apt 1.0 onwards."""
+    version = installed_version('apt')
+    try:
+        return int(upstream_version(version or '0').split('.')[0]) >= 1
+    except ValueError:
+        return False
+
+
+class AptTransaction(object):
+    """A batch of package operations run with as few apt commands as
+    possible.
+
+    Install, upgrade and hold intents are collected and executed by
+    :meth:`commit`. Intents that are already satisfied according to
+    :func:`package_index` are dropped without running apt at all, and the
+    remaining installs and upgrade are done by a single apt-get invocation
+    (two on releases older than apt 1.0), followed by one apt-mark for
+    holds. Use :func:`apt_transaction` rather than instantiating this.
+    """
+
+    def __init__(self, options=None, fatal=False):
+        self.options = options
+        self.fatal = fatal
+        self.reset()
+
+    def reset(self):
+        """Forget all intents"""
+        self._update = False
+        self._update_max_age = None
+        self._upgrade = None
+        self._install = []
+        self._hold = []
+
+    def update(self, max_age=None):
+        """Update the package lists before anything else is done, unless
+        they are fresh; see :func:`apt_update` for max_age."""
+        self._update = True
+        self._update_max_age = max_age
+
+    def install(self, packages):
+        """Install one or more packages, unless already installed"""
+        if isinstance(packages, six.string_types):
+            packages = [packages]
+        self._install.extend(p for p in packages if p not in self._install)
+
+    def upgrade(self, dist=False):
+        """Upgrade all packages, with dist-upgrade if dist is True"""
+        self._upgrade = bool(self._upgrade) or dist
+
+    def hold(self, packages):
+        """Hold one or more packages, unless already held"""
+        if isinstance(packages, six.string_types):
+            packages = [packages]
+        self._hold.extend(p for p in packages if p not in self._hold)
+
+    def commit(self):
+        """Run the outstanding intents and forget them"""
+        if self._update:
+            apt_update(fatal=self.fatal, max_age=self._update_max_age)
+        installed = package_index()
+        installs = [p for p in self._install if p not in installed]
+        if self._upgrade is not None:
+            options = self.options
+            if options is None:
+                options = ['--option=Dpkg::Options::=--force-confold']
+            cmd = ['apt-get', '--assume-yes']
+            cmd.extend(options)
+            cmd.append('dist-upgrade' if self._upgrade else 'upgrade')
+            if installs and _apt_upgrade_takes_packages():
+                cmd.extend(installs)
+                installs = []
+            log("Upgrading with options: {}".format(options))
+            _run_apt_command(cmd, self.fatal)
+        if installs:
+            apt_install(installs, options=self.options, fatal=self.fatal)
+        installed = package_index()
+        holds = [p for p in self._hold
+                 if not installed.get(p, {}).get('hold')]
+        if holds:
+            apt_hold(holds, fatal=self.fatal)
+        self.reset()
+
+
+# Transaction that nested apt_transaction blocks join, see apt_transaction.
+_apt_transaction = None
+
+
+@contextmanager
+def apt_transaction(options=None, fatal=False):
+    """Collect package operations into an :class:`AptTransaction` committed
+    when the block exits without error::
+
+        with apt_transaction(fatal=True) as apt:
+            apt.update()
+            apt.install(['haproxy', 'apache2'])
+            apt.hold('haproxy')
+
+    Blocks entered within another join the outer transaction, which then
+    carries out their intents when it commits, with its own options, and
+    fatally if any of the blocks asked for it.
+    """
+    global _apt_transaction
+    if _apt_transaction is not None:
+        _apt_transaction.fatal = _apt_transaction.fatal or fatal
+        yield _apt_transaction
+        return
+    _apt_transaction = AptTransaction(options=options, fatal=fatal)
+    try:
+        yield _apt_transaction
+        _apt_transaction.commit()
+    finally:
+        _apt_transaction = None
 
 
 def add_source(source, key=None):
@@ -402,38 +703,93 @@ def plugins(fetch_handlers=None):
     return plugin_list
 
 
+def _dpkg_lock_held(path):
+    """Return True if another process holds the lock file at path.
+
+    The lock is queried with F_GETLK rather than taken, so that dpkg or apt
+    trying it without waiting at the same moment does not fail.
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except (IOError, OSError):
+        # Missing, or we may not query it anyway
+        return False
+    try:
+        query = struct.pack(_FLOCK_FORMAT, fcntl.F_WRLCK, os.SEEK_SET,
+                            0, 0, 0)
+        result = fcntl.fcntl(fd, fcntl.F_GETLK, query)
+    finally:
+        os.close(fd)
+    return struct.unpack(_FLOCK_FORMAT, result)[0] != fcntl.F_UNLCK
+
+
+def _dpkg_locks_held():
+    """Return True if another process holds any of APT_LOCKS"""
+    return any(_dpkg_lock_held(lock) for lock in APT_LOCKS)
+
+
+def wait_for_dpkg_lock(timeout=APT_LOCK_TIMEOUT):
+    """Wait for the dpkg and apt locks to be free.
+
+    The locks are probed without blocking, backing off from
+    APT_LOCK_POLL_MIN up to APT_LOCK_POLL_MAX seconds between attempts, so
+    that waiting ends shortly after the holder, such as unattended-upgrades,
+    releases them. Time spent here is reported to the profiler as
+    'dpkg lock wait'.
+
+    :param timeout: seconds to wait at most.
+    :returns: True if the locks are free, False if the timeout expired.
+    """
+    deadline = time.time() + timeout
+    delay = APT_LOCK_POLL_MIN
+    with profiler.timed('dpkg lock wait'):
+        while _dpkg_locks_held():
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            if delay == APT_LOCK_POLL_MIN:
+                log('Waiting up to {:.0f}s for the dpkg lock to be '
+                    'released'.format(remaining))
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, APT_LOCK_POLL_MAX)
+    return True
+
+
+@profiler.profiled('apt')
 def _run_apt_command(cmd, fatal=False):
     """
-    Run an APT command, checking output and retrying if the fatal flag is set
-    to True.
+    Run an APT command, waiting for the dpkg lock to be released beforehand
+    and retrying if it was taken again before apt could acquire it, for up
+    to APT_LOCK_TIMEOUT seconds overall. apt exits with APT_NO_LOCK on any
+    error, so other failures are not retried.
 
     :param: cmd: str: The apt command to run.
-    :param: fatal: bool: Whether the command's output should be checked and
-        retried.
+    :param: fatal: bool: Whether the command's exit status should be checked,
+        raising CalledProcessError on failure.
+    :returns: int: The exit status of the command.
     """
-    env = os.environ.copy()
+    try:
+        env = os.environ.copy()
 
-    if 'DEBIAN_FRONTEND' not in env:
-        env['DEBIAN_FRONTEND'] = 'noninteractive'
+        if 'DEBIAN_FRONTEND' not in env:
+            env['DEBIAN_FRONTEND'] = 'noninteractive'
 
-    if fatal:
+        deadline = time.time() + APT_LOCK_TIMEOUT
         retry_count = 0
-        result = None
-
-        # If the command is considered "fatal", we need to retry if the apt
-        # lock was not acquired.
-
-        while result is None or result == APT_NO_LOCK:
-            try:
-                result = subprocess.check_call(cmd, env=env)
-            except subprocess.CalledProcessError as e:
-                retry_count = retry_count + 1
-                if retry_count > APT_NO_LOCK_RETRY_COUNT:
-                    raise
-                result = e.returncode
-                log("Couldn't acquire DPKG lock. Will retry in {} seconds."
-                    "".format(APT_NO_LOCK_RETRY_DELAY))
-                time.sleep(APT_NO_LOCK_RETRY_DELAY)
-
-    else:
-        subprocess.call(cmd, env=env)
+        while True:
+            wait_for_dpkg_lock(max(deadline - time.time(), 0))
+            result = subprocess.call(cmd, env=env)
+            # The lock may have been taken again since we probed it
+            if (result != APT_NO_LOCK or time.time() >= deadline or
+                    retry_count >= APT_NO_LOCK_RETRY_COUNT or
+                    not _dpkg_locks_held()):
+                break
+            retry_count += 1
+            log("Couldn't acquire DPKG lock. Retrying once it is released.")
+
+        if fatal and result != 0:
+            raise subprocess.CalledProcessError(result, cmd)
+        return result
+    finally:
+        # Installed packages or package lists may have changed
+        _packages_changed()
@@ -20,13 +20,13 @@ TO_PATCH = [
     'configure_installation_source',
     'openstack_upgrade_available',
     'do_openstack_upgrade',
-    'apt_install',
-    'apt_update',
+    'apt_transaction',
     'open_port',
     'config',
     'log',
     'relation_ids',
-    'filter_installed_packages',
+    'related_units',
+    'local_unit',
     'CONFIGS',
     'get_ceilometer_context',
     'lsb_release',
@@ -35,6 +35,9 @@ TO_PATCH = [
     'service_restart',
     'update_nrpe_config',
     'configure_https',
+    'configure_expirer',
+    'check_dbsync',
+    'migrate_database',
 ]
 
 
@@ -44,8 +47,7 @@ class CeilometerHooksTest(CharmTestCase):
         super(CeilometerHooksTest, self).setUp(hooks, TO_PATCH)
         self.config.side_effect = self.test_config.get
         self.get_packages.return_value = ceilometer_utils.CEILOMETER_PACKAGES
-        self.filter_installed_packages.return_value = \
-            ceilometer_utils.CEILOMETER_PACKAGES
+        self.apt = self.apt_transaction.return_value.__enter__.return_value
         self.lsb_release.return_value = {'DISTRIB_CODENAME': 'precise'}
 
     @patch('charmhelpers.payload.execd.default_execd_dir',
@@ -65,11 +67,10 @@ class CeilometerHooksTest(CharmTestCase):
         self.configure_installation_source.\
             assert_called_with('cloud:precise-grizzly')
         self.open_port.assert_called_with(hooks.CEILOMETER_PORT)
-        self.apt_update.assert_called_with(fatal=True)
-        self.apt_install.assert_called_with(
-            ceilometer_utils.CEILOMETER_PACKAGES,
-            fatal=True
-        )
+        self.apt_transaction.assert_called_with(fatal=True)
+        self.apt.update.assert_called_with(max_age=14400)
+        self.apt.install.assert_called_with(
+            ceilometer_utils.CEILOMETER_PACKAGES)
 
     @patch('charmhelpers.payload.execd.default_execd_dir',
            return_value=os.path.join(os.getcwd(), 'exec.d'))
@@ -80,11 +81,10 @@ class CeilometerHooksTest(CharmTestCase):
         self.configure_installation_source.\
             assert_called_with('distro')
         self.open_port.assert_called_with(hooks.CEILOMETER_PORT)
-        self.apt_update.assert_called_with(fatal=True)
-        self.apt_install.assert_called_with(
-            ceilometer_utils.CEILOMETER_PACKAGES,
-            fatal=True
-        )
+        self.apt_transaction.assert_called_with(fatal=True)
+        self.apt.update.assert_called_with(max_age=14400)
+        self.apt.install.assert_called_with(
+            ceilometer_utils.CEILOMETER_PACKAGES)
 
     @patch('charmhelpers.core.hookenv.config')
     def test_amqp_joined(self, mock_config):
@@ -103,9 +103,61 @@ class CeilometerHooksTest(CharmTestCase):
     @patch.object(hooks, 'ceilometer_joined')
     def test_any_changed(self, joined, mock_config):
         hooks.hooks.execute(['hooks/shared-db-relation-changed'])
-        self.assertTrue(self.CONFIGS.write_all.called)
+        self.assertTrue(self.CONFIGS.write_affected.called)
+        self.assertFalse(self.CONFIGS.write_all.called)
         self.assertTrue(joined.called)
 
+    @patch('charmhelpers.core.hookenv.config')
+    @patch.object(hooks, 'ceilometer_joined')
+    def test_mysql_db_changed(self, joined, mock_config):
+        self.CONFIGS.complete_contexts.return_value = ['mysql-db']
+        self.relation_ids.return_value = ['mysql-db:1']
+        self.related_units.return_value = ['mysql/0']
+        self.local_unit.return_value = 'ceilometer/1'
+        self.relation_get.return_value = 'ceilometer/0 ceilometer/1'
+        hooks.hooks.execute(['hooks/mysql-db-relation-changed'])
+        self.assertTrue(self.CONFIGS.write_affected.called)
+        self.assertTrue(joined.called)
+        self.relation_get.assert_called_with('allowed_units',
+                                             rid='mysql-db:1', unit='mysql/0')
+        self.assertTrue(self.migrate_database.called)
+
+    @patch('charmhelpers.core.hookenv.config')
+    @patch.object(hooks, 'ceilometer_joined')
+    def test_mysql_db_changed_not_allowed(self, joined, mock_config):
+        self.CONFIGS.complete_contexts.return_value = ['mysql-db']
+        self.relation_ids.return_value = ['mysql-db:1']
+        self.related_units.return_value = ['mysql/0']
+        self.local_unit.return_value = 'ceilometer/1'
+        self.relation_get.return_value = 'ceilometer/0 ceilometer/10'
+        hooks.hooks.execute(['hooks/mysql-db-relation-changed'])
+        self.assertFalse(self.migrate_database.called)
+        self.relation_get.return_value = None
+        hooks.hooks.execute(['hooks/mysql-db-relation-changed'])
+        self.assertFalse(self.migrate_database.called)
+
+    @patch('charmhelpers.core.hookenv.config')
+    @patch.object(hooks, 'ceilometer_joined')
+    def test_mysql_db_changed_incomplete(self, joined, mock_config):
+        self.CONFIGS.complete_contexts.return_value = []
+        hooks.hooks.execute(['hooks/mysql-db-relation-changed'])
+        self.assertTrue(self.CONFIGS.write_affected.called)
+        self.assertFalse(self.migrate_database.called)
+
+    @patch('charmhelpers.core.hookenv.config')
+    @patch.object(hooks, 'unit_get')
+    @patch.object(hooks, 'is_relation_made')
+    def test_mysql_db_joined(self, relation_made, unit_get, mock_config):
+        relation_made.return_value = False
+        unit_get.return_value = '10.0.0.1'
+        self.config.side_effect = None
+        self.config.return_value = self.test_config.get_all()
+        hooks.hooks.execute(['hooks/mysql-db-relation-joined'])
+        self.relation_set.assert_called_with(database='ceilometer',
+                                             username='ceilometer',
+                                             hostname='10.0.0.1')
+        self.assertFalse(self.migrate_database.called)
+
     @patch('charmhelpers.core.hookenv.config')
     @patch.object(hooks, 'install')
     @patch.object(hooks, 'any_changed')
@@ -124,6 +176,7 @@ class CeilometerHooksTest(CharmTestCase):
         self.assertFalse(self.do_openstack_upgrade.called)
         self.assertTrue(self.CONFIGS.write_all.called)
         self.assertTrue(joined.called)
+        self.assertTrue(self.configure_expirer.called)
 
     @patch('charmhelpers.core.hookenv.config')
     @patch.object(hooks, 'ceilometer_joined')
@@ -202,6 +255,7 @@ class CeilometerHooksTest(CharmTestCase):
         self.relation_get.return_value = None
         hooks.hooks.execute(['hooks/cluster-relation-changed'])
         self.assertFalse(shared_secret.called)
+        self.assertTrue(self.configure_expirer.called)
 
     @patch('charmhelpers.core.hookenv.config')
     @patch.object(hooks, 'get_shared_secret')
@@ -321,3 +375,4 @@ class CeilometerHooksTest(CharmTestCase):
         self.relation_ids.return_value = ['identity-service/0']
         hooks.hooks.execute(['hooks/ha-relation-changed'])
         self.assertEquals(mock_keystone_joined.call_count, 1)
+        self.assertTrue(self.configure_expirer.called)
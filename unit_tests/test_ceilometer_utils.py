@@ -1,3 +1,5 @@
+import os
+
 from mock import patch, call, MagicMock
 
 import ceilometer_utils as utils
@@ -14,9 +16,12 @@ TO_PATCH = [
     'CeilometerContext',
     'config',
     'log',
-    'apt_install',
-    'apt_update',
-    'apt_upgrade',
+    'apt_transaction',
+    'is_elected_leader',
+    'write_file',
+    'installed_version',
+    'unitdata',
+    'subprocess',
 ]
 
 
@@ -25,6 +30,10 @@ class CeilometerUtilsTest(CharmTestCase):
     def setUp(self):
         super(CeilometerUtilsTest, self).setUp(utils, TO_PATCH)
         self.config.side_effect = self.test_config.get
+        self.kv_store = {}
+        self.kv = self.unitdata.kv.return_value
+        self.kv.get.side_effect = self.kv_store.get
+        self.kv.set.side_effect = self.kv_store.__setitem__
 
     def tearDown(self):
         super(CeilometerUtilsTest, self).tearDown()
@@ -36,26 +45,46 @@ class CeilometerUtilsTest(CharmTestCase):
             calls.append(call(conf,
                               utils.CONFIG_FILES[conf]['hook_contexts']))
         configs.register.assert_has_calls(calls, any_order=True)
+        _, kwargs = self.templating.OSConfigRenderer.call_args
+        self.assertEquals(kwargs['render_threads'], len(utils.CONFIG_FILES))
 
     def test_restart_map(self):
         restart_map = utils.restart_map()
+        common = ['DEFAULT', 'database', 'publisher_rpc',
+                  'service_credentials']
+
+        def sections(own):
+            return sorted(common + [own])
         self.assertEquals(
             restart_map,
-            {'/etc/ceilometer/ceilometer.conf': [
-                'ceilometer-agent-central',
-                'ceilometer-collector',
-                'ceilometer-api',
-                'ceilometer-alarm-evaluator',
-                'ceilometer-alarm-notifier',
-                'ceilometer-agent-notification'],
-             '/etc/haproxy/haproxy.cfg': ['haproxy'],
-             "/etc/apache2/sites-available/openstack_https_frontend": [
-                 'apache2'],
-             "/etc/apache2/sites-available/openstack_https_frontend.conf": [
-                 'apache2']
+            {'/etc/ceilometer/ceilometer.conf': {
+                'ceilometer-agent-central': sections('central'),
+                'ceilometer-collector': sections('collector'),
+                'ceilometer-api': 'restart',
+                'ceilometer-alarm-evaluator': sections('alarm'),
+                'ceilometer-alarm-notifier': sections('alarm'),
+                'ceilometer-agent-notification': sections('notification')},
+             '/etc/haproxy/haproxy.cfg': {'haproxy': 'reload'},
+             "/etc/apache2/sites-available/openstack_https_frontend": {
+                 'apache2': 'reload'},
+             "/etc/apache2/sites-available/openstack_https_frontend.conf": {
+                 'apache2': 'reload'}
              }
         )
 
+    def test_services(self):
+        self.assertEquals(
+            sorted(utils.services()),
+            sorted(utils.CEILOMETER_SERVICES + ['haproxy', 'apache2']))
+
+    def test_service_sections(self):
+        self.assertEquals(utils.service_sections('ceilometer-api'),
+                          ['DEFAULT', 'database', 'publisher_rpc',
+                           'service_credentials'])
+        self.assertEquals(utils.service_sections('ceilometer-collector'),
+                          ['DEFAULT', 'collector', 'database',
+                           'publisher_rpc', 'service_credentials'])
+
     def test_get_ceilometer_conf(self):
         class TestContext():
 
@@ -76,15 +105,16 @@ class CeilometerUtilsTest(CharmTestCase):
         utils.do_openstack_upgrade(configs)
         configs.set_release.assert_called_with(openstack_release='havana')
         self.log.assert_called()
-        self.apt_update.assert_called_with(fatal=True)
         dpkg_opts = [
             '--option', 'Dpkg::Options::=--force-confnew',
             '--option', 'Dpkg::Options::=--force-confdef',
         ]
-        self.apt_install.assert_called_with(
-            packages=utils.CEILOMETER_PACKAGES,
-            options=dpkg_opts, fatal=True
-        )
+        self.apt_transaction.assert_called_with(options=dpkg_opts,
+                                                fatal=True)
+        apt = self.apt_transaction.return_value.__enter__.return_value
+        apt.update.assert_called_with(max_age=14400)
+        apt.upgrade.assert_called_with(dist=True)
+        apt.install.assert_called_with(utils.CEILOMETER_PACKAGES)
         self.configure_installation_source.assert_called_with(
             'cloud:precise-havana'
         )
@@ -98,3 +128,163 @@ class CeilometerUtilsTest(CharmTestCase):
         self.get_os_codename_install_source.return_value = 'icehouse'
         self.assertEqual(utils.get_packages(),
                          utils.CEILOMETER_PACKAGES + utils.ICEHOUSE_PACKAGES)
+
+    @patch('os.path.exists')
+    def test_configure_expirer(self, exists):
+        self.test_config.set('metering-time-to-live', 86400)
+        self.test_config.set('expirer-schedule', '0 4 * * *')
+        self.test_config.set('expirer-max-runtime', 600)
+        self.is_elected_leader.return_value = True
+        utils.configure_expirer()
+        self.is_elected_leader.assert_called_with(utils.CLUSTER_RES)
+        path, content = self.write_file.call_args[0]
+        self.assertEquals(path, utils.EXPIRER_CRON)
+        self.assertIn('0 4 * * * ceilometer timeout 600 flock -n '
+                      '/var/lock/ceilometer-expirer.lock ', content)
+        self.assertIn(' ceilometer-expirer >> ', content)
+        self.assertEquals(self.write_file.call_args[1], {'perms': 0o644})
+
+    @patch('os.remove')
+    @patch('os.path.exists')
+    def test_configure_expirer_not_leader(self, exists, remove):
+        self.test_config.set('metering-time-to-live', 86400)
+        self.is_elected_leader.return_value = False
+        exists.return_value = True
+        utils.configure_expirer()
+        self.assertFalse(self.write_file.called)
+        remove.assert_called_with(utils.EXPIRER_CRON)
+
+    @patch('os.remove')
+    @patch('os.path.exists')
+    def test_configure_expirer_keep_forever(self, exists, remove):
+        self.test_config.set('metering-time-to-live', -1)
+        self.is_elected_leader.return_value = True
+        exists.return_value = False
+        utils.configure_expirer()
+        self.assertFalse(self.write_file.called)
+        self.assertFalse(remove.called)
+
+    def test_migrate_database(self):
+        self.is_elected_leader.return_value = True
+        self.installed_version.return_value = '2014.1-0ubuntu1'
+        self.subprocess.call.return_value = 0
+        with patch('ceilometer_utils.open', create=True):
+            utils.migrate_database()
+        self.assertEquals(self.subprocess.call.call_args[0][0],
+                          ['ceilometer-dbsync'])
+        self.assertEquals(self.kv_store[utils.DBSYNC_KEY],
+                          {'revision': '2014.1-0ubuntu1'})
+
+        self.subprocess.call.reset_mock()
+        utils.migrate_database()
+        self.assertFalse(self.subprocess.call.called)
+
+    def test_migrate_database_failed(self):
+        self.is_elected_leader.return_value = True
+        self.installed_version.return_value = '2014.1-0ubuntu1'
+        self.subprocess.call.return_value = 1
+        with patch('ceilometer_utils.open', create=True):
+            utils.migrate_database()
+        self.assertEquals(self.kv_store[utils.DBSYNC_KEY], {})
+
+    def test_migrate_database_not_leader(self):
+        self.is_elected_leader.return_value = False
+        utils.migrate_database()
+        self.assertFalse(self.installed_version.called)
+        self.assertFalse(self.subprocess.call.called)
+
+    @patch.object(utils, '_process_start')
+    @patch('os.path.exists')
+    def test_migrate_database_background(self, exists, process_start):
+        process_start.return_value = 'boot:100'
+        self.test_config.set('dbsync-background', True)
+        self.is_elected_leader.return_value = True
+        self.installed_version.return_value = '2014.1-0ubuntu1'
+        self.subprocess.Popen.return_value.pid = 1234
+        exists.return_value = False
+        with patch('ceilometer_utils.open', create=True):
+            utils.migrate_database()
+        self.assertFalse(self.subprocess.call.called)
+        state = self.kv_store[utils.DBSYNC_KEY]
+        self.assertEquals(state['pending'], '2014.1-0ubuntu1')
+        self.assertEquals(state['pid'], 1234)
+        self.assertEquals(state['process'], 'boot:100')
+        process_start.assert_called_with(1234)
+        self.assertNotIn('revision', state)
+
+    @patch.object(utils, '_process_start')
+    @patch('os.path.exists')
+    def test_check_dbsync_running(self, exists, process_start):
+        self.kv_store[utils.DBSYNC_KEY] = {'pending': '2014.1-0ubuntu1',
+                                           'pid': 1234, 'started': 0,
+                                           'process': 'boot:100'}
+        exists.return_value = False
+        process_start.return_value = 'boot:100'
+        self.assertTrue(utils.check_dbsync())
+        process_start.assert_called_with(1234)
+
+    @patch.object(utils, '_process_start')
+    @patch('os.path.exists')
+    def test_check_dbsync_pid_reused(self, exists, process_start):
+        self.kv_store[utils.DBSYNC_KEY] = {'pending': '2014.1-0ubuntu1',
+                                           'pid': 1234, 'started': 0,
+                                           'process': 'boot:100'}
+        exists.return_value = False
+        # After a reboot, an unrelated process runs with the same pid
+        process_start.return_value = 'reboot:42'
+        self.assertFalse(utils.check_dbsync())
+        self.assertEquals(self.kv_store[utils.DBSYNC_KEY], {})
+
+    @patch.object(utils, '_process_start')
+    @patch('os.remove')
+    @patch('os.path.exists')
+    def test_check_dbsync_exited_since_status_check(self, exists, remove,
+                                                      process_start):
+        self.kv_store[utils.DBSYNC_KEY] = {'pending': '2014.1-0ubuntu1',
+                                           'pid': 1234, 'started': 0,
+                                           'process': 'boot:100'}
+        # The status is written as the process exits, so it only appears
+        # after the liveness check
+        process_start.return_value = None
+        exists.side_effect = lambda path: process_start.called
+        _open = MagicMock()
+        _open.return_value.__enter__.return_value.read.return_value = '0\n'
+        with patch('ceilometer_utils.open', _open, create=True):
+            self.assertFalse(utils.check_dbsync())
+        self.assertEquals(self.kv_store[utils.DBSYNC_KEY],
+                          {'revision': '2014.1-0ubuntu1'})
+
+    @patch.object(utils, '_process_start')
+    @patch('os.path.exists')
+    def test_check_dbsync_start_unknown(self, exists, process_start):
+        # The process exited before its start could be recorded
+        self.kv_store[utils.DBSYNC_KEY] = {'pending': '2014.1-0ubuntu1',
+                                           'pid': 1234, 'started': 0,
+                                           'process': None}
+        exists.return_value = False
+        process_start.return_value = None
+        self.assertFalse(utils.check_dbsync())
+        self.assertEquals(self.kv_store[utils.DBSYNC_KEY], {})
+
+    def test_process_start(self):
+        start = utils._process_start(os.getpid())
+        self.assertTrue(start)
+        self.assertEquals(utils._process_start(os.getpid()), start)
+        # init started at boot, well before this process
+        self.assertNotEqual(utils._process_start(1), start)
+        # Beyond the largest possible pid_max
+        self.assertIsNone(utils._process_start(2 ** 22 + 1))
+
+    @patch('os.remove')
+    @patch('os.path.exists')
+    def test_check_dbsync_finished(self, exists, remove):
+        self.kv_store[utils.DBSYNC_KEY] = {'pending': '2014.1-0ubuntu1',
+                                           'pid': 1234, 'started': 0}
+        exists.return_value = True
+        _open = MagicMock()
+        _open.return_value.__enter__.return_value.read.return_value = '0\n'
+        with patch('ceilometer_utils.open', _open, create=True):
+            self.assertFalse(utils.check_dbsync())
+        remove.assert_called_with(utils.DBSYNC_STATUS)
+        self.assertEquals(self.kv_store[utils.DBSYNC_KEY],
+                          {'revision': '2014.1-0ubuntu1'})
@@ -0,0 +1,384 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from mock import patch, MagicMock
+
+from charmhelpers import fetch
+from charmhelpers.contrib.openstack import utils as openstack_utils
+
+from test_utils import CharmTestCase
+
+TO_PATCH = [
+    'log',
+    'wait_for_dpkg_lock',
+    '_dpkg_locks_held',
+    '_packages_changed',
+]
+
+
+class DpkgLockTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.lock = os.path.join(self.tmpdir, 'lock')
+        open(self.lock, 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_lock_free(self):
+        self.assertFalse(fetch._dpkg_lock_held(self.lock))
+
+    def test_lock_missing(self):
+        self.assertFalse(fetch._dpkg_lock_held(
+            os.path.join(self.tmpdir, 'missing')))
+
+    def test_lock_held(self):
+        holder = subprocess.Popen(
+            [sys.executable, '-c',
+             'import fcntl, sys\n'
+             'f = open(sys.argv[1], "w")\n'
+             'fcntl.lockf(f, fcntl.LOCK_EX)\n'
+             'sys.stdout.write("locked\\n")\n'
+             'sys.stdout.flush()\n'
+             'sys.stdin.read()\n', self.lock],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        try:
+            self.assertEquals(holder.stdout.readline().strip(), b'locked')
+            self.assertTrue(fetch._dpkg_lock_held(self.lock))
+            # Probing must not take the lock from under the holder
+            self.assertTrue(fetch._dpkg_lock_held(self.lock))
+        finally:
+            holder.communicate()
+        self.assertFalse(fetch._dpkg_lock_held(self.lock))
+
+
+class RunAptCommandTest(CharmTestCase):
+
+    def setUp(self):
+        super(RunAptCommandTest, self).setUp(fetch, TO_PATCH)
+
+    @patch('subprocess.call')
+    def test_success(self, _call):
+        _call.return_value = 0
+        self.assertEquals(fetch._run_apt_command(['apt-get', 'update']), 0)
+        self.assertEquals(_call.call_count, 1)
+        self.assertTrue(self._packages_changed.called)
+
+    @patch('subprocess.call')
+    def test_failure_not_retried(self, _call):
+        _call.return_value = fetch.APT_NO_LOCK
+        self._dpkg_locks_held.return_value = False
+        self.assertEquals(fetch._run_apt_command(['apt-get', 'install',
+                                                  'nonexistent']),
+                          fetch.APT_NO_LOCK)
+        self.assertEquals(_call.call_count, 1)
+
+    @patch('subprocess.call')
+    def test_lock_contention_retried(self, _call):
+        _call.side_effect = [fetch.APT_NO_LOCK, 0]
+        self._dpkg_locks_held.return_value = True
+        self.assertEquals(fetch._run_apt_command(['apt-get', 'update']), 0)
+        self.assertEquals(_call.call_count, 2)
+        self.assertEquals(self.wait_for_dpkg_lock.call_count, 2)
+
+    @patch('subprocess.call')
+    def test_fatal(self, _call):
+        _call.return_value = 1
+        self.assertRaises(subprocess.CalledProcessError,
+                          fetch._run_apt_command, ['apt-get', 'update'],
+                          fatal=True)
+        self.assertTrue(self._packages_changed.called)
+
+
+class AptCacheTest(CharmTestCase):
+
+    def setUp(self):
+        super(AptCacheTest, self).setUp(fetch, ['log', 'wait_for_dpkg_lock'])
+        fetch.invalidate_apt_cache()
+        self.addCleanup(fetch.invalidate_apt_cache)
+        self.apt_pkg = MagicMock()
+        self.apt_pkg.Cache.side_effect = lambda: object()
+        _modules = patch.dict(sys.modules, {'apt_pkg': self.apt_pkg})
+        _modules.start()
+        self.addCleanup(_modules.stop)
+
+    def test_shared(self):
+        cache = fetch.apt_cache()
+        self.assertIs(fetch.apt_cache(), cache)
+        self.assertIs(fetch.apt_cache(in_memory=True), cache)
+        on_disk = fetch.apt_cache(in_memory=False)
+        self.assertIsNot(on_disk, cache)
+        self.assertIs(fetch.apt_cache(in_memory=False), on_disk)
+        self.assertEquals(self.apt_pkg.Cache.call_count, 2)
+
+    def test_invalidated_by_apt_commands(self):
+        cache = fetch.apt_cache()
+        with patch('subprocess.call', return_value=0):
+            fetch._run_apt_command(['apt-get', 'update'])
+        self.assertIsNot(fetch.apt_cache(), cache)
+
+
+class AptTransactionTest(CharmTestCase):
+
+    def setUp(self):
+        super(AptTransactionTest, self).setUp(fetch, [
+            'log',
+            'package_index',
+            'installed_version',
+            'apt_update',
+            'apt_install',
+            'apt_hold',
+            '_run_apt_command',
+        ])
+        self.installed = {'haproxy': {'version': '1.4', 'hold': False},
+                          'apache2': {'version': '2.4', 'hold': True}}
+        self.package_index.side_effect = lambda: self.installed
+        self.installed_version.return_value = '1.0.1ubuntu2'
+
+    def test_installed_packages_skipped(self):
+        with fetch.apt_transaction() as apt:
+            apt.install(['haproxy', 'apache2'])
+            apt.hold('apache2')
+        self.assertFalse(self.apt_install.called)
+        self.assertFalse(self.apt_hold.called)
+        self.assertFalse(self._run_apt_command.called)
+
+    def test_install_and_hold(self):
+        with fetch.apt_transaction() as apt:
+            apt.update(max_age=60)
+            apt.install('haproxy')
+            apt.install(['mysql-client', 'haproxy', 'mysql-client'])
+            apt.hold(['haproxy', 'apache2'])
+        self.apt_update.assert_called_with(fatal=False, max_age=60)
+        self.apt_install.assert_called_with(['mysql-client'], options=None,
+                                            fatal=False)
+        self.apt_hold.assert_called_with(['haproxy'], fatal=False)
+
+    def test_upgrade_folds_installs(self):
+        opts = ['--option', 'Dpkg::Options::=--force-confnew']
+        with fetch.apt_transaction(options=opts, fatal=True) as apt:
+            apt.upgrade(dist=True)
+            apt.install(['haproxy', 'ceilometer-api', 'ceilometer-common'])
+        self._run_apt_command.assert_called_once_with(
+            ['apt-get', '--assume-yes'] + opts +
+            ['dist-upgrade', 'ceilometer-api', 'ceilometer-common'], True)
+        self.assertFalse(self.apt_install.called)
+
+    def test_upgrade_before_apt_1_0(self):
+        self.installed_version.return_value = '0.9.7.9ubuntu4'
+        with fetch.apt_transaction() as apt:
+            apt.upgrade()
+            apt.install('ceilometer-api')
+        self._run_apt_command.assert_called_once_with(
+            ['apt-get', '--assume-yes',
+             '--option=Dpkg::Options::=--force-confold', 'upgrade'], False)
+        self.apt_install.assert_called_with(['ceilometer-api'], options=None,
+                                            fatal=False)
+
+    def test_nested_joins_outer(self):
+        with fetch.apt_transaction() as outer:
+            outer.install('mysql-client')
+            with fetch.apt_transaction(fatal=True) as inner:
+                self.assertIs(inner, outer)
+                inner.install('python-dbus')
+            self.assertFalse(self.apt_install.called)
+        self.apt_install.assert_called_once_with(
+            ['mysql-client', 'python-dbus'], options=None, fatal=True)
+        self.assertIsNone(fetch._apt_transaction)
+
+    def test_fatal_propagates(self):
+        self.apt_install.side_effect = subprocess.CalledProcessError(
+            100, 'apt-get')
+        with self.assertRaises(subprocess.CalledProcessError):
+            with fetch.apt_transaction(fatal=True) as apt:
+                apt.install('nonexistent')
+        self.apt_install.assert_called_with(['nonexistent'], options=None,
+                                            fatal=True)
+        self.assertIsNone(fetch._apt_transaction)
+
+    def test_not_committed_on_error(self):
+        with self.assertRaises(ValueError):
+            with fetch.apt_transaction() as apt:
+                apt.install('mysql-client')
+                raise ValueError()
+        self.assertFalse(self.apt_install.called)
+        self.assertIsNone(fetch._apt_transaction)
+
+
+DPKG_STATUS = """Package: haproxy
+Status: install ok installed
+Priority: optional
+Version: 1.4.24-2ubuntu0.2
+Description: fast and reliable load balancing reverse proxy
+ HAProxy is a TCP/HTTP reverse proxy.
+ Version: 0.0 in a continuation line
+
+Package: apache2
+Status: hold ok installed
+Version: 2.4.7-1ubuntu4
+
+Package: ceilometer-common
+Status: install reinstreq half-installed
+Version: 1:2014.1.3-0ubuntu1
+
+Package: mongodb
+Status: deinstall ok config-files
+Version: 1:2.4.9-1ubuntu2
+
+Package: libc6
+Status: install ok installed
+Architecture: amd64
+Version: 2.19-0ubuntu6
+
+Package: libc6
+Status: install ok installed
+Architecture: i386
+Version: 2.19-0ubuntu5
+"""
+
+
+class PackageIndexTest(CharmTestCase):
+
+    def setUp(self):
+        super(PackageIndexTest, self).setUp(fetch, ['log', 'charm_dir',
+                                                    'unitdata'])
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.status = os.path.join(self.tmpdir, 'status')
+        self.write(DPKG_STATUS)
+        _status = patch.object(fetch, 'DPKG_STATUS', self.status)
+        _status.start()
+        self.addCleanup(_status.stop)
+        self.addCleanup(setattr, fetch, '_package_index', None)
+        fetch._package_index = None
+        self.charm_dir.return_value = '/var/lib/juju/agents/unit-x/charm'
+        self.kv_store = {}
+        kv = self.unitdata.kv.return_value
+        kv.get.side_effect = self.kv_store.get
+        kv.set.side_effect = self.kv_store.__setitem__
+
+    def write(self, content, mtime=1000000000):
+        with open(self.status, 'w') as f:
+            f.write(content)
+        os.utime(self.status, (mtime, mtime))
+
+    def test_parse_dpkg_status(self):
+        self.assertEquals(fetch.parse_dpkg_status(self.status), {
+            'haproxy': {'version': '1.4.24-2ubuntu0.2', 'hold': False},
+            'apache2': {'version': '2.4.7-1ubuntu4', 'hold': True},
+            'ceilometer-common': {'version': '1:2014.1.3-0ubuntu1',
+                                  'hold': False},
+            'libc6': {'version': '2.19-0ubuntu6', 'hold': False},
+        })
+
+    def test_parse_dpkg_status_no_trailing_blank_line(self):
+        self.write('Package: a\nStatus: install ok installed\nVersion: 1')
+        self.assertEquals(fetch.parse_dpkg_status(self.status),
+                          {'a': {'version': '1', 'hold': False}})
+
+    def test_fingerprint_reused(self):
+        with patch.object(fetch, 'parse_dpkg_status',
+                          wraps=fetch.parse_dpkg_status) as parse:
+            packages = fetch.package_index()
+            self.assertIs(fetch.package_index(), packages)
+            # A later hook loads the index from the key value store
+            fetch._package_index = None
+            self.assertEquals(fetch.package_index(), packages)
+        self.assertEquals(parse.call_count, 1)
+        self.assertEquals(self.kv_store[fetch.PACKAGE_INDEX_KEY]['packages'],
+                          packages)
+
+    def test_stale_index_refreshed(self):
+        fetch.package_index()
+        self.write(DPKG_STATUS.replace('1.4.24-2ubuntu0.2', '1.4.24-3'),
+                   mtime=1000000001)
+        self.assertEquals(fetch.installed_version('haproxy'), '1.4.24-3')
+        self.assertEquals(
+            self.kv_store[fetch.PACKAGE_INDEX_KEY]['packages']['haproxy'],
+            {'version': '1.4.24-3', 'hold': False})
+
+    def test_missing_status(self):
+        os.remove(self.status)
+        self.assertEquals(fetch.package_index(), {})
+        self.assertIsNone(fetch.installed_version('haproxy'))
+        self.assertIsNone(openstack_utils.get_os_codename_package(
+            'ceilometer-common', fatal=False))
+
+    def test_installed_version(self):
+        self.assertEquals(fetch.installed_version('apache2'),
+                          '2.4.7-1ubuntu4')
+        self.assertIsNone(fetch.installed_version('mongodb'))
+        self.assertIsNone(fetch.installed_version('nonexistent'))
+
+    def test_upstream_version(self):
+        self.assertEquals(fetch.upstream_version('1:2014.1.3-0ubuntu1'),
+                          '2014.1.3')
+        self.assertEquals(fetch.upstream_version('2.4.7-1ubuntu4'), '2.4.7')
+        self.assertEquals(fetch.upstream_version('1.0-rc1-2'), '1.0-rc1')
+        self.assertEquals(fetch.upstream_version('1.2.3'), '1.2.3')
+
+
+class AptUpdateTest(CharmTestCase):
+
+    def setUp(self):
+        super(AptUpdateTest, self).setUp(fetch, [
+            'log',
+            'charm_dir',
+            'unitdata',
+            '_apt_sources_fingerprint',
+            '_run_apt_command',
+        ])
+        self.charm_dir.return_value = '/var/lib/juju/agents/unit-x/charm'
+        self.kv_store = {}
+        kv = self.unitdata.kv.return_value
+        kv.get.side_effect = self.kv_store.get
+        kv.set.side_effect = self.kv_store.__setitem__
+        self._apt_sources_fingerprint.return_value = 'sources'
+        self._run_apt_command.return_value = 0
+
+    def updated(self, age):
+        self.kv_store[fetch.APT_UPDATE_KEY] = {'sources': 'sources',
+                                               'time': time.time() - age}
+
+    def test_update(self):
+        fetch.apt_update(fatal=True)
+        self._run_apt_command.assert_called_with(['apt-get', 'update'], True)
+        self.assertEquals(self.kv_store[fetch.APT_UPDATE_KEY]['sources'],
+                          'sources')
+
+    def test_fresh_lists_reused(self):
+        self.updated(60)
+        fetch.apt_update()
+        self.assertFalse(self._run_apt_command.called)
+
+    def test_sources_changed(self):
+        self.updated(60)
+        self._apt_sources_fingerprint.return_value = 'new sources'
+        fetch.apt_update()
+        self.assertTrue(self._run_apt_command.called)
+        self.assertEquals(self.kv_store[fetch.APT_UPDATE_KEY]['sources'],
+                          'new sources')
+
+    def test_max_age_exceeded(self):
+        self.updated(fetch.APT_UPDATE_MAX_AGE + 60)
+        fetch.apt_update()
+        self.assertTrue(self._run_apt_command.called)
+
+    def test_max_age(self):
+        self.updated(60)
+        fetch.apt_update(max_age=30)
+        self.assertEquals(self._run_apt_command.call_count, 1)
+        self.updated(60)
+        fetch.apt_update(max_age=0)
+        self.assertEquals(self._run_apt_command.call_count, 2)
+
+    def test_failed_update_not_recorded(self):
+        self._run_apt_command.return_value = 100
+        fetch.apt_update()
+        self.assertNotIn(fetch.APT_UPDATE_KEY, self.kv_store)
@@ -0,0 +1,144 @@
+import json
+import unittest
+
+from mock import patch
+
+from charmhelpers.core import hookenv
+
+
+def relation_get(attribute=None, unit=None, rid=None):
+    pass
+
+
+ARGSPEC = hookenv._getargspec(relation_get)
+
+
+class CachedTest(unittest.TestCase):
+
+    def setUp(self):
+        for store in (hookenv.cache, hookenv.cache_index,
+                      hookenv.cache_stats):
+            self.addCleanup(store.clear)
+            store.clear()
+        self.calls = []
+
+        @hookenv.cached
+        def lookup(attribute=None, unit=None, rid=None):
+            self.calls.append((attribute, unit, rid))
+            return len(self.calls)
+        self.lookup = lookup
+
+    def test_cache_key_normalised(self):
+        keys = [hookenv._cache_key(relation_get, ARGSPEC, args, kwargs)[0]
+                for args, kwargs in [(('a', 'u/0'), {}),
+                                     (('a',), {'unit': 'u/0'}),
+                                     ((), {'attribute': 'a', 'unit': 'u/0',
+                                           'rid': None})]]
+        self.assertEquals(len(set(keys)), 1)
+        other, _ = hookenv._cache_key(relation_get, ARGSPEC, ('a', 'u/1'),
+                                      {})
+        self.assertNotEqual(keys[0], other)
+
+    def test_cache_key_bound(self):
+        _, bound = hookenv._cache_key(relation_get, ARGSPEC, ('a',),
+                                      {'rid': 'db:1'})
+        self.assertEquals(bound, {'attribute': 'a', 'unit': None,
+                                  'rid': 'db:1'})
+
+    def test_cached(self):
+        self.assertEquals(self.lookup('a', 'u/0', 'db:1'), 1)
+        self.assertEquals(self.lookup('a', unit='u/0', rid='db:1'), 1)
+        self.assertEquals(self.lookup('b', 'u/0', 'db:1'), 2)
+        self.assertEquals(hookenv.cache_stats['lookup'],
+                          {'hits': 1, 'misses': 2})
+
+    def test_unhashable_arguments(self):
+        self.assertEquals(self.lookup(attribute=object, unit=['u/0'],
+                                      rid='db:1'), 1)
+        self.assertEquals(self.lookup('a', 'u/0', rid={'db': [1]}), 2)
+        self.assertEquals(self.lookup('a', 'u/0', rid={'db': [1]}), 2)
+
+    def test_flush_relation(self):
+        self.lookup('a', 'u/0', 'db:1')
+        self.lookup('a', 'u/1', 'db:1')
+        self.lookup('a', 'u/0', 'db:2')
+        hookenv.flush_relation('db:1', 'u/0')
+        self.assertEquals(self.lookup('a', 'u/0', 'db:1'), 4)
+        self.assertEquals(self.lookup('a', 'u/1', 'db:1'), 2)
+        self.assertEquals(self.lookup('a', 'u/0', 'db:2'), 3)
+        self.assertEquals(len(self.calls), 4)
+
+    @patch.dict('os.environ', {'JUJU_RELATION_ID': 'db:1',
+                               'JUJU_REMOTE_UNIT': 'mysql/0'})
+    @patch.object(hookenv, 'local_unit')
+    @patch('subprocess.check_call')
+    def test_relation_set_flushes_local_unit(self, check_call, local_unit):
+        local_unit.return_value = 'ceilometer/0'
+        self.lookup('a', 'ceilometer/0', 'db:1')
+        self.lookup('a', None, 'db:1')
+        hookenv.relation_set(a='1')
+        self.assertEquals(self.lookup('a', 'ceilometer/0', 'db:1'), 3)
+        # Remote settings cannot have changed
+        self.assertEquals(self.lookup('a', None, 'db:1'), 2)
+
+
+class RelationPrefetchTest(unittest.TestCase):
+
+    SETTINGS = {'mysql/0': {'host': '10.0.0.1', 'password': 'secret'},
+                'mysql/1': {'host': '10.0.0.2'}}
+
+    def setUp(self):
+        for store in (hookenv.cache, hookenv.cache_index,
+                      hookenv.cache_stats, hookenv.relation_snapshots):
+            self.addCleanup(store.clear)
+            store.clear()
+        self.addCleanup(hookenv.relation_prefetch_mode, False)
+        self.calls = []
+        for target, side_effect in [
+                ('subprocess.check_output', self.check_output),
+                ('charmhelpers.core.hookenv.related_units',
+                 lambda rid: sorted(self.SETTINGS))]:
+            _patch = patch(target, side_effect=side_effect)
+            _patch.start()
+            self.addCleanup(_patch.stop)
+        _environ = patch.dict('os.environ', {'JUJU_RELATION_ID': 'db:1',
+                                             'JUJU_REMOTE_UNIT': 'mysql/0'})
+        _environ.start()
+        self.addCleanup(_environ.stop)
+
+    def check_output(self, cmd):
+        ''' relation-get --format=json -r <rid> <attribute> <unit> '''
+        self.calls.append(cmd)
+        settings = self.SETTINGS[cmd[-1]]
+        if cmd[-2] != '-':
+            settings = settings.get(cmd[-2])
+        return json.dumps(settings).encode('UTF-8')
+
+    def test_disabled(self):
+        self.assertEquals(hookenv.relation_get('host', 'mysql/0'),
+                          '10.0.0.1')
+        self.assertEquals(hookenv.relation_get(unit='mysql/1', rid='db:1'),
+                          self.SETTINGS['mysql/1'])
+        self.assertEquals(len(self.calls), 2)
+        self.assertEquals(hookenv.relation_snapshots, {})
+
+    def test_attribute(self):
+        hookenv.relation_prefetch_mode()
+        self.assertEquals(hookenv.relation_get('host'), '10.0.0.1')
+        self.assertEquals(hookenv.relation_get('password', 'mysql/0'),
+                          'secret')
+        self.assertEquals(hookenv.relation_get('host', 'mysql/1', 'db:1'),
+                          '10.0.0.2')
+        self.assertIsNone(hookenv.relation_get('password', 'mysql/1'))
+        # One call fetching all settings of each unit
+        self.assertEquals([cmd[-2:] for cmd in self.calls],
+                          [['-', 'mysql/0'], ['-', 'mysql/1']])
+
+    def test_all_settings(self):
+        hookenv.relation_prefetch_mode()
+        self.assertEquals(hookenv.relation_get(), self.SETTINGS['mysql/0'])
+        self.assertEquals(hookenv.relation_get(unit='mysql/1', rid='db:1'),
+                          self.SETTINGS['mysql/1'])
+        self.assertEquals(hookenv.relation_get('host', 'mysql/1'),
+                          '10.0.0.2')
+        self.assertEquals(len(self.calls), 2)
@@ -0,0 +1,120 @@
+import unittest
+
+from mock import patch, MagicMock
+
+from charmhelpers.core import hookenv, profiler
+
+
+class ProfilerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        profiler.reset()
+        profiler.enable()
+        self.addCleanup(profiler.reset)
+        self.addCleanup(profiler.enable, False)
+
+
+class ProfilerTest(ProfilerTestCase):
+
+    def test_disabled(self):
+        profiler.enable(False)
+        with profiler.context('FooContext'):
+            with profiler.timed('relation-get'):
+                pass
+        self.assertEquals(profiler.summary()['operations'], {})
+
+    def test_timed(self):
+        with profiler.timed('relation-get'):
+            pass
+        with profiler.context('FooContext'):
+            with profiler.timed('relation-get'):
+                pass
+            self.assertEquals(profiler.current_context(), 'FooContext')
+        self.assertIsNone(profiler.current_context())
+        operations = profiler.summary()['operations']
+        self.assertEquals(sorted(operations),
+                          ['context FooContext', 'relation-get'])
+        self.assertEquals(operations['relation-get']['calls'], 2)
+        self.assertEquals(operations['relation-get']['contexts'],
+                          {'FooContext': 1})
+
+    def test_timed_failure(self):
+        with self.assertRaises(ValueError):
+            with profiler.timed('config-get'):
+                raise ValueError()
+        self.assertEquals(
+            profiler.summary()['operations']['config-get']['calls'], 1)
+
+    def test_profiled(self):
+        @profiler.profiled('render')
+        def render(a, b=None):
+            return a, b
+        self.assertEquals(render(1, b=2), (1, 2))
+        self.assertEquals(
+            profiler.summary()['operations']['render']['calls'], 1)
+
+    def test_summary(self):
+        profiler.record('relation-get', 0.25, 'FooContext')
+        profiler.record('relation-get', 0.5)
+        data = profiler.summary('config-changed', 1.5,
+                                {'relation_get': {'hits': 3, 'misses': 1}})
+        self.assertEquals(data['hook'], 'config-changed')
+        self.assertEquals(data['time'], 1.5)
+        self.assertEquals(data['operations'], {
+            'relation-get': {'calls': 2, 'time': 0.75,
+                             'contexts': {'FooContext': 1}}})
+        self.assertEquals(data['cache'],
+                          {'relation_get': {'hits': 3, 'misses': 1}})
+        report = profiler.format_summary(data).splitlines()
+        self.assertEquals(report[0], 'Profile of hook config-changed: 1.500s')
+        self.assertIn('(FooContext: 1)', report[1])
+        self.assertIn('3 hits', report[2])
+
+    def test_persist(self):
+        kv = MagicMock()
+        kv.get.return_value = [{'hook': i} for i in range(profiler.HISTORY)]
+        profiler.persist({'hook': 'install'}, kv)
+        history = kv.set.call_args[0][1]
+        self.assertEquals(len(history), profiler.HISTORY)
+        self.assertEquals(history[0], {'hook': 1})
+        self.assertEquals(history[-1], {'hook': 'install'})
+        self.assertTrue(kv.flush.called)
+
+
+class HooksProfileTest(ProfilerTestCase):
+
+    def setUp(self):
+        super(HooksProfileTest, self).setUp()
+        self.hooks = hookenv.Hooks(config_save=False)
+        _log = patch.object(hookenv, 'log')
+        _log.start()
+        self.addCleanup(_log.stop)
+        _persist = patch.object(profiler, 'persist')
+        self.persist = _persist.start()
+        self.addCleanup(_persist.stop)
+
+    def test_reported(self):
+        @self.hooks.hook('install')
+        def install():
+            with profiler.timed('apt-get'):
+                pass
+        self.hooks.execute(['hooks/install'])
+        data = self.persist.call_args[0][0]
+        self.assertEquals(data['hook'], 'install')
+        self.assertEquals(data['operations']['apt-get']['calls'], 1)
+
+    def test_reported_on_failure(self):
+        @self.hooks.hook('install')
+        def install():
+            raise ValueError()
+        self.assertRaises(ValueError, self.hooks.execute, ['hooks/install'])
+        self.assertEquals(self.persist.call_args[0][0]['hook'], 'install')
+
+    def test_disabled(self):
+        profiler.enable(False)
+
+        @self.hooks.hook('install')
+        def install():
+            pass
+        self.hooks.execute(['hooks/install'])
+        self.assertFalse(self.persist.called)
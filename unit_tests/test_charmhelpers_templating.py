@@ -0,0 +1,328 @@
+import imp
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import threading
+import time
+
+from mock import patch
+
+from charmhelpers.contrib.openstack import context, templating
+from charmhelpers.core import host
+
+from test_utils import CharmTestCase
+
+TO_PATCH = [
+    'log',
+    'charm_dir',
+]
+
+
+class FakeContext(object):
+    ''' Context generator returning settings, counting its calls '''
+    interfaces = []
+
+    def __init__(self, **settings):
+        self.settings = settings
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if isinstance(self.settings.get('error'), Exception):
+            raise self.settings['error']
+        return dict(self.settings)
+
+
+class TemplatingTestCase(CharmTestCase):
+
+    def setUp(self):
+        super(TemplatingTestCase, self).setUp(templating, TO_PATCH)
+        self.charm_dir.return_value = None
+        templating.flush_context_cache()
+        self.addCleanup(templating.flush_context_cache)
+        host._file_digests.clear()
+        self.addCleanup(host._file_digests.clear)
+        self.templates = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.templates)
+        self.etc = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.etc)
+        self.configs = templating.OSConfigRenderer(
+            templates_dir=self.templates, openstack_release='icehouse')
+
+    def register(self, name, template, contexts):
+        with open(os.path.join(self.templates, name), 'w') as f:
+            f.write(template)
+        path = os.path.join(self.etc, name)
+        self.configs.register(path, contexts)
+        return path
+
+    def read(self, path):
+        with open(path) as f:
+            return f.read()
+
+
+class WriteFilesTest(TemplatingTestCase):
+
+    def test_write(self):
+        path = self.register('a.conf', 'a = {{ a }}\n', [FakeContext(a=1)])
+        self.assertTrue(self.configs.write(path))
+        self.assertEquals(self.read(path), 'a = 1')
+
+    def test_identical_render_untouched(self):
+        path = self.register('a.conf', 'a = {{ a }}\n', [FakeContext(a=1)])
+        with open(path, 'w') as f:
+            f.write('a = 1')
+        os.utime(path, (1000000000, 1000000000))
+        inode = os.stat(path).st_ino
+        self.assertEquals(self.configs.write_all(), {path: False})
+        st = os.stat(path)
+        self.assertEquals((st.st_ino, st.st_mtime), (inode, 1000000000))
+
+    def test_changed_render(self):
+        context = FakeContext(a=1)
+        path = self.register('a.conf', 'a = {{ a }}\n', [context])
+        other = self.register('b.conf', 'b\n', [])
+        self.assertEquals(self.configs.write_all(), {path: True, other: True})
+        context.settings['a'] = 2
+        templating.flush_context_cache()
+        self.assertEquals(self.configs.write_all(),
+                          {path: True, other: False})
+        self.assertEquals(self.read(path), 'a = 2')
+
+    def test_render_error_leaves_no_temp_files(self):
+        path = self.register('a.conf', 'a = {{ a }}\n', [FakeContext(a=1)])
+        self.register('b.conf', 'b\n', [FakeContext(error=ValueError())])
+        self.assertRaises(ValueError, self.configs.write_all)
+        self.assertEquals(os.listdir(self.etc), [])
+        self.assertFalse(os.path.exists(path))
+
+    def test_write_error_leaves_no_temp_files(self):
+        path = self.register('a.conf', 'a = {{ a }}\n', [FakeContext(a=1)])
+        with open(os.path.join(self.templates, 'b.conf'), 'w') as f:
+            f.write('b\n')
+        # The replacement for a file in a missing directory cannot be opened
+        self.configs.register(os.path.join(self.etc, 'missing', 'b.conf'),
+                              [])
+        self.assertRaises(OSError, self.configs.write_all)
+        self.assertEquals(os.listdir(self.etc), [])
+        self.assertFalse(os.path.exists(path))
+
+
+class AtomicReplaceTest(TemplatingTestCase):
+
+    def setUp(self):
+        super(AtomicReplaceTest, self).setUp()
+        self.events = []
+        for name in ('fsync', 'rename'):
+            real = getattr(os, name)
+            _patch = patch.object(templating.os, name,
+                                  side_effect=self.record(name, real))
+            _patch.start()
+            self.addCleanup(_patch.stop)
+
+    def record(self, name, real):
+        def recorded(*args):
+            self.events.append(name)
+            return real(*args)
+        return recorded
+
+    def test_owner_and_mode_preserved(self):
+        path = self.register('a.conf', 'a = {{ a }}\n', [FakeContext(a=1)])
+        with open(path, 'w') as f:
+            f.write('old')
+        os.chmod(path, 0o640)
+        st = os.stat(path)
+        with patch.object(templating.os, 'fchown') as fchown:
+            self.assertTrue(self.configs.write(path))
+        self.assertEquals(fchown.call_args[0][1:], (st.st_uid, st.st_gid))
+        self.assertEquals(stat.S_IMODE(os.stat(path).st_mode), 0o640)
+        self.assertNotEqual(os.stat(path).st_ino, st.st_ino)
+        self.assertEquals(self.read(path), 'a = 1')
+
+    @patch.object(templating, '_fsync_dir')
+    def test_single_fsync_batch(self, _fsync_dir):
+        self.register('a.conf', 'a', [])
+        self.register('b.conf', 'b', [])
+        self.configs.write_all()
+        # Every file is synced before any is renamed into place
+        self.assertEquals(self.events, ['fsync', 'fsync', 'rename', 'rename'])
+        _fsync_dir.assert_called_once_with(self.etc)
+
+    def test_symlink_written_through(self):
+        target = os.path.join(self.templates, 'real.conf')
+        with open(target, 'w') as f:
+            f.write('old')
+        path = self.register('a.conf', 'a = {{ a }}\n', [FakeContext(a=1)])
+        os.symlink(target, path)
+        self.assertTrue(self.configs.write(path))
+        self.assertTrue(os.path.islink(path))
+        self.assertEquals(self.read(target), 'a = 1')
+        self.assertEquals(os.listdir(self.etc), ['a.conf'])
+        self.assertFalse(self.configs.write(path))
+
+
+class SettingContext(FakeContext):
+    ''' Context generator recording settings on itself when called, like
+    SharedDBContext '''
+
+    def __call__(self):
+        self.user = 'ceilometer'
+        return super(SettingContext, self).__call__()
+
+
+class EvaluateContextTest(TemplatingTestCase):
+
+    def setUp(self):
+        super(EvaluateContextTest, self).setUp()
+        self.relation_writes = self.patch('relation_writes')
+        self.relation_writes.return_value = 0
+
+    def test_equal_contexts_share_result(self):
+        first, second = FakeContext(a=1), FakeContext(a=1)
+        self.assertEquals(templating.evaluate_context(first), {'a': 1})
+        self.assertEquals(templating.evaluate_context(second), {'a': 1})
+        self.assertEquals((first.calls, second.calls), (1, 0))
+        other = FakeContext(a=2)
+        self.assertEquals(templating.evaluate_context(other), {'a': 2})
+        self.assertEquals(other.calls, 1)
+
+    def test_key_stable_when_context_sets_attributes(self):
+        context = SettingContext(a=1)
+        templating.evaluate_context(context)
+        templating.evaluate_context(context)
+        self.assertEquals(context.calls, 1)
+        self.assertEquals(len(templating._context_cache), 1)
+
+    def test_relation_set_invalidates(self):
+        context = FakeContext(a=1)
+        templating.evaluate_context(context)
+        self.relation_writes.return_value = 1
+        templating.evaluate_context(context)
+        templating.evaluate_context(context)
+        self.assertEquals(context.calls, 2)
+
+    def test_rendered_once_per_hook(self):
+        context = FakeContext(a=1)
+        path = self.register('a.conf', 'a = {{ a }}', [context])
+        self.register('b.conf', 'b = {{ a }}', [context])
+        self.configs.write_all()
+        self.configs.write(path)
+        self.assertEquals(context.calls, 1)
+
+
+class TrackedContext(FakeContext):
+    ''' Context generator declaring the relation and config keys it reads '''
+
+    def __init__(self, interfaces, config_keys, **settings):
+        super(TrackedContext, self).__init__(**settings)
+        self.interfaces = interfaces
+        self.config_keys = config_keys
+
+
+class WriteAffectedTest(TemplatingTestCase):
+
+    def setUp(self):
+        super(WriteAffectedTest, self).setUp()
+        for name in ('hook_name', 'relation_type', 'config'):
+            setattr(self, name, self.patch(name))
+        self.relation_type.return_value = None
+        self.db = self.register('db.conf', 'db', [
+            TrackedContext(['shared-db'], ['database'])])
+        self.amqp = self.register('amqp.conf', 'amqp', [
+            TrackedContext(['amqp'], ['rabbit-user']),
+            TrackedContext([], ['debug'])])
+        self.api = self.register('api.conf', 'api', [
+            TrackedContext([], ['debug'])])
+
+    def test_relation(self):
+        self.assertEquals(self.configs.affected_files(relation='amqp'),
+                          [self.amqp])
+        self.assertEquals(self.configs.affected_files(relation='ha'), [])
+
+    def test_config_keys(self):
+        self.assertEquals(self.configs.affected_files(config_keys=['debug']),
+                          [self.amqp, self.api])
+        self.assertEquals(
+            self.configs.affected_files(relation='shared-db',
+                                        config_keys=['rabbit-user']),
+            [self.db, self.amqp])
+
+    def test_untracked_always_affected(self):
+        other = self.register('other.conf', 'other', [FakeContext()])
+        self.assertEquals(self.configs.affected_files(relation='amqp'),
+                          [self.amqp, other])
+        # Declaring dependencies on re-registration stops forcing the file
+        self.configs.register(other, [TrackedContext(['ha'], [])])
+        self.assertEquals(self.configs.affected_files(relation='amqp'),
+                          [self.amqp])
+
+    def test_write_affected_relation_hook(self):
+        self.hook_name.return_value = 'amqp-relation-changed'
+        self.relation_type.return_value = 'amqp'
+        self.assertEquals(self.configs.write_affected(), {self.amqp: True})
+
+    def test_write_affected_config_changed(self):
+        self.hook_name.return_value = 'config-changed'
+        self.config.return_value.keys.return_value = ['debug', 'database']
+        self.config.return_value.changed.side_effect = \
+            lambda key: key == 'debug'
+        self.assertEquals(self.configs.write_affected(),
+                          {self.amqp: True, self.api: True})
+
+    def test_write_affected_other_hook(self):
+        self.hook_name.return_value = 'upgrade-charm'
+        self.assertEquals(self.configs.write_affected(),
+                          {self.db: True, self.amqp: True, self.api: True})
+
+
+class RenderThreadsTest(TemplatingTestCase):
+
+    def setUp(self):
+        super(RenderThreadsTest, self).setUp()
+        self.configs.render_threads = 2
+
+    def test_rendered_concurrently(self):
+        started = {'a': threading.Event(), 'b': threading.Event()}
+        overlapped = []
+
+        class WaitingContext(FakeContext):
+            ''' Waits for the other file's context to start '''
+            def __call__(self):
+                name, other = self.settings['name'], self.settings['other']
+                started[name].set()
+                overlapped.append(started[other].wait(5))
+                return super(WaitingContext, self).__call__()
+
+        shared = FakeContext(shared=1)
+        a = self.register('a.conf', '{{ name }} {{ shared }}', [
+            WaitingContext(name='a', other='b'), shared])
+        b = self.register('b.conf', '{{ name }} {{ shared }}', [
+            WaitingContext(name='b', other='a'), shared])
+        self.assertEquals(self.configs.write_all(), {a: True, b: True})
+        self.assertEquals(overlapped, [True, True])
+        self.assertEquals(shared.calls, 1)
+        self.assertEquals((self.read(a), self.read(b)), ('a 1', 'b 1'))
+
+    @patch.object(context, 'apt_install')
+    def test_num_cpus_installs_psutil_once(self, apt_install):
+        psutil = imp.new_module('psutil')
+        psutil.NUM_CPUS = 4
+
+        def install(*args, **kwargs):
+            # Leave time for another thread to find psutil missing
+            time.sleep(0.1)
+            sys.modules['psutil'] = psutil
+        apt_install.side_effect = install
+
+        cpus = []
+        workers = [threading.Thread(target=lambda: cpus.append(
+            context.WorkerConfigContext().num_cpus)) for _ in range(2)]
+        with patch.dict(sys.modules, {'psutil': None}):
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+        self.assertEquals(cpus, [4, 4])
+        apt_install.assert_called_once_with('python-psutil', fatal=True)
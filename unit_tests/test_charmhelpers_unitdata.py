@@ -0,0 +1,151 @@
+import json
+import unittest
+
+from mock import patch, MagicMock
+
+from charmhelpers.core import unitdata
+
+
+class FakeHookenv(object):
+    ''' The hook tools of a unit related to mysql and amqp units '''
+
+    def __init__(self, relations, hook='config-changed', rid=None):
+        # relation type -> relation id -> unit -> settings
+        self.relations = relations
+        self.hook = hook
+        self.rid = rid
+        self.relation_snapshots = {}
+        self.relation_id_snapshots = {}
+        self.fetched = []
+
+    def hook_name(self):
+        return self.hook
+
+    def relation_types(self):
+        return sorted(self.relations)
+
+    def relation_type(self):
+        return self.rid.split(':')[0] if self.rid else None
+
+    def relation_id(self):
+        return self.rid
+
+    def relation_ids(self, reltype):
+        return sorted(self.relations.get(reltype, {}))
+
+    def related_units(self, rid):
+        return sorted(self.relations[rid.split(':')[0]].get(rid, {}))
+
+    def relation_get(self, unit, rid):
+        self.fetched.append((rid, unit))
+        return dict(self.relations[rid.split(':')[0]][rid][unit])
+
+
+class RelationSnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = {}
+        self.kv = MagicMock()
+        self.kv.get.side_effect = self.store.get
+        self.kv.set.side_effect = self.set
+        _kv = patch.object(unitdata, 'kv', return_value=self.kv)
+        _kv.start()
+        self.addCleanup(_kv.stop)
+        self.relations = {
+            'mysql-db': {'mysql-db:1': {'mysql/0': {'password': 'a'}}},
+            'amqp': {'amqp:2': {'rabbit/0': {'password': 'b'},
+                                'rabbit/1': {'password': 'c'}}},
+        }
+
+    def set(self, key, value):
+        # Stored as json, like unitdata.Storage does
+        self.store[key] = json.loads(json.dumps(value))
+
+    def run_hook(self, hook='config-changed', rid=None, remote_unit=None):
+        hookenv = FakeHookenv(self.relations, hook, rid)
+        env = {'JUJU_REMOTE_UNIT': remote_unit} if remote_unit else {}
+        with patch.dict('os.environ', env):
+            unitdata.RelationSnapshot().load(hookenv)
+        unitdata.RelationSnapshot().save(hookenv)
+        return hookenv
+
+    def test_first_hook_fetches_all(self):
+        hookenv = self.run_hook()
+        self.assertEquals(sorted(hookenv.fetched),
+                          [('amqp:2', 'rabbit/0'), ('amqp:2', 'rabbit/1'),
+                           ('mysql-db:1', 'mysql/0')])
+        self.assertEquals(hookenv.relation_id_snapshots,
+                          {'amqp': ['amqp:2'], 'mysql-db': ['mysql-db:1']})
+        self.assertEquals(hookenv.relation_snapshots['amqp:2']['rabbit/1'],
+                          {'password': 'c'})
+        self.assertEquals(self.store[unitdata.RelationSnapshot.KEY]['units'],
+                          hookenv.relation_snapshots)
+        self.assertTrue(self.kv.flush.called)
+
+    def test_non_relation_hook_uses_snapshot(self):
+        self.run_hook()
+        self.relations['amqp']['amqp:2']['rabbit/0']['password'] = 'd'
+        hookenv = self.run_hook()
+        self.assertEquals(hookenv.fetched, [])
+        self.assertEquals(hookenv.relation_snapshots['amqp:2']['rabbit/0'],
+                          {'password': 'b'})
+
+    def test_changed_refreshes_remote_unit(self):
+        self.run_hook()
+        self.relations['amqp']['amqp:2']['rabbit/0']['password'] = 'd'
+        hookenv = self.run_hook('amqp-relation-changed', 'amqp:2', 'rabbit/0')
+        self.assertEquals(hookenv.fetched, [('amqp:2', 'rabbit/0')])
+        self.assertEquals(hookenv.relation_snapshots['amqp:2'],
+                          {'rabbit/0': {'password': 'd'},
+                           'rabbit/1': {'password': 'c'}})
+
+    def test_joined_fetches_new_unit(self):
+        self.run_hook()
+        self.relations['amqp']['amqp:2']['rabbit/2'] = {'password': 'e'}
+        hookenv = self.run_hook('amqp-relation-joined', 'amqp:2', 'rabbit/2')
+        self.assertEquals(hookenv.fetched, [('amqp:2', 'rabbit/2')])
+        self.assertEquals(sorted(hookenv.relation_snapshots['amqp:2']),
+                          ['rabbit/0', 'rabbit/1', 'rabbit/2'])
+
+    def test_departed_drops_unit(self):
+        self.run_hook()
+        del self.relations['amqp']['amqp:2']['rabbit/1']
+        hookenv = self.run_hook('amqp-relation-departed', 'amqp:2',
+                                'rabbit/1')
+        self.assertEquals(hookenv.fetched, [])
+        self.assertEquals(hookenv.relation_snapshots['amqp:2'],
+                          {'rabbit/0': {'password': 'b'}})
+
+    def test_broken_drops_relation(self):
+        self.run_hook()
+        # relation-ids still lists a relation in its broken hook
+        hookenv = self.run_hook('mysql-db-relation-broken', 'mysql-db:1')
+        self.assertEquals(hookenv.fetched, [])
+        self.assertEquals(hookenv.relation_id_snapshots['mysql-db'], [])
+        self.assertNotIn('mysql-db:1', hookenv.relation_snapshots)
+        self.assertIn('amqp:2', hookenv.relation_snapshots)
+
+    def test_upgrade_charm_refreshes_all(self):
+        self.run_hook()
+        self.relations['amqp']['amqp:2']['rabbit/0']['password'] = 'd'
+        hookenv = self.run_hook('upgrade-charm')
+        self.assertEquals(len(hookenv.fetched), 3)
+        self.assertEquals(hookenv.relation_snapshots['amqp:2']['rabbit/0'],
+                          {'password': 'd'})
+
+    @patch.object(unitdata.RelationSnapshot, 'save')
+    @patch.object(unitdata.RelationSnapshot, 'load')
+    def test_context_manager(self, load, save):
+        with unitdata.RelationSnapshot() as snapshot:
+            self.assertTrue(load.called)
+            self.assertFalse(save.called)
+        self.assertIsInstance(snapshot, unitdata.RelationSnapshot)
+        self.assertTrue(save.called)
+
+    @patch.object(unitdata.RelationSnapshot, 'save')
+    @patch.object(unitdata.RelationSnapshot, 'load')
+    def test_not_saved_on_failure(self, load, save):
+        with self.assertRaises(ValueError):
+            with unitdata.RelationSnapshot():
+                raise ValueError()
+        self.assertFalse(save.called)